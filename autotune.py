@@ -0,0 +1,153 @@
+import os
+import json
+import time
+from argparse import ArgumentParser
+import config
+from oracle import EnginePool
+
+PROC_CGROUP = "/proc/self/cgroup"
+PROC_MOUNTINFO = "/proc/self/mountinfo"
+
+def cgroup_dirs(controller):
+    '''
+    Directories that may hold limits on this process for controller: its own cgroup and every ancestor up to the mount root,
+    in the v2 hierarchy and in any v1 hierarchy with controller (hybrid hosts mount both).
+    Batch schedulers such as SLURM put a job in a nested cgroup, so the limit is rarely in the root directory.
+    '''
+    try:
+        with open(PROC_CGROUP, encoding="utf-8") as f:
+            memberships = [line.rstrip("\n").split(":", 2) for line in f if line.count(":") >= 2]
+        with open(PROC_MOUNTINFO, encoding="utf-8") as f:
+            mounts = [line.split() for line in f]
+    except OSError:
+        return list()
+    dirs = list()
+    for fields in mounts:
+        # mount root and mount point come before the "-" separator, filesystem type and super options after it
+        separator = fields.index("-")
+        root, mount_point = fields[3], fields[4]
+        fstype, options = fields[separator + 1], fields[separator + 3].split(",")
+        for hierarchy, controllers, path in memberships:
+            if fstype == "cgroup2":
+                matches = hierarchy == "0"
+            else:
+                matches = fstype == "cgroup" and controller in controllers.split(",") and controller in options
+            relative = os.path.relpath(path, root)
+            # a cgroup outside the mounted subtree cannot be read from this mount
+            if not matches or relative.startswith(".."):
+                continue
+            directory = os.path.normpath(os.path.join(mount_point, relative))
+            dirs.append(directory)
+            while directory != mount_point:
+                directory = os.path.dirname(directory)
+                dirs.append(directory)
+    return dirs
+
+def _read_cgroup_file(directory, name):
+    try:
+        with open(os.path.join(directory, name), encoding="utf-8") as f:
+            return f.read().split()
+    except OSError:
+        return None
+
+def available_cpus():
+    '''CPUs this process may run on: its affinity mask, further limited by the smallest CPU quota of its cgroups (v2 cpu.max, v1 CFS quota)'''
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    for directory in cgroup_dirs("cpu"):
+        quota = _read_cgroup_file(directory, "cpu.max")
+        if quota is None:
+            quota, period = _read_cgroup_file(directory, "cpu.cfs_quota_us"), _read_cgroup_file(directory, "cpu.cfs_period_us")
+            quota = quota + period if quota and period else None
+        # v2 writes "max" and v1 -1 when there is no quota
+        if quota and len(quota) == 2 and quota[0] not in ("max", "-1"):
+            cpus = min(cpus, max(1, int(quota[0]) // int(quota[1])))
+    return cpus
+
+def memory_limit_mb():
+    '''Memory this process may use: physical memory, further limited by the smallest v2 memory.max or v1 limit_in_bytes of its cgroups'''
+    limit = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    for directory in cgroup_dirs("memory"):
+        for name in ("memory.max", "memory.limit_in_bytes"):
+            value = _read_cgroup_file(directory, name)
+            # v2 writes "max" and v1 a huge number when there is no limit
+            if value and value[0] != "max":
+                limit = min(limit, int(value[0]))
+    return limit // 2**20
+
+def candidate_configs(cpus, memory_mb, hash_sizes=config.PIKAFISH_HASH_SIZES_MB):
+    '''
+    (engines, threads, hash_mb) combinations that use every CPU once and fit in memory_mb.
+    Engine counts are powers of two up to the number of CPUs, plus the number of CPUs itself.
+    '''
+    engine_counts = sorted({2 ** i for i in range(cpus.bit_length()) if 2 ** i <= cpus} | {cpus})
+    configs = list()
+    for engines in engine_counts:
+        for hash_mb in hash_sizes:
+            if engines * (hash_mb + config.PIKAFISH_BASE_MEMORY_MB) <= memory_mb:
+                configs.append((engines, cpus // engines, hash_mb))
+    return configs
+
+def calibrate(games, configs, movetime, binary=None, plies=20):
+    '''
+    Annotates two game openings per engine with every configuration.
+    @param games: list of move lists to sample openings from
+    returns: one dict per configuration with its positions per second
+    '''
+    results = list()
+    for engines, threads, hash_mb in configs:
+        jobs = [games[i % len(games)][:plies] for i in range(2 * engines)]
+        positions = sum(map(len, jobs))
+        with EnginePool(engines, threads, binary=binary, hash_mb=hash_mb) as pool:
+            # engine start up is paid once per run, so it is kept out of the measurement
+            try:
+                pool.start()
+            except (TimeoutError, OSError) as error:
+                pool.failed.append((None, error))
+            else:
+                tick = time.perf_counter()
+                for _ in pool.map(lambda engine, moves: engine.annotate_moves(moves, movetime), jobs):
+                    pass
+                elapsed = time.perf_counter() - tick
+            failed = len(pool.failed)
+        # a configuration whose engines hang or crash is not an option
+        positions_per_sec = positions / elapsed if not failed else 0.0
+        results.append({"engines": engines, "threads": threads, "hash_mb": hash_mb, "positions_per_sec": positions_per_sec})
+        print(f"engines {engines:3d} threads {threads:3d} hash {hash_mb:5d} MB: {positions_per_sec:8.1f} positions/s")
+    return results
+
+def load_or_calibrate(games, movetime=config.PIKAFISH_MOVETIME_MS, binary=None, path=config.AUTOTUNE_PATH, force=False):
+    '''
+    Best configuration for this machine, calibrated once and reused while CPUs, memory limit, engine and movetime stay the same.
+    returns: dict with engines, threads, hash_mb and positions_per_sec
+    '''
+    machine = {"cpus": available_cpus(), "memory_mb": memory_limit_mb(),
+               "binary": binary or config.PATH_TO_PIKAFISH_BINARY, "movetime_ms": movetime}
+    if not force and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            saved = json.load(f)
+        if saved["machine"] == machine:
+            return saved["best"]
+
+    configs = candidate_configs(machine["cpus"], machine["memory_mb"])
+    if not configs:
+        raise MemoryError(f"Not even one engine fits in {machine['memory_mb']} MB")
+    print(f"Calibrating {len(configs)} configurations for {machine['cpus']} CPUs and {machine['memory_mb']} MB...")
+    results = calibrate(games, configs, movetime, binary)
+    best = max(results, key=lambda result: result["positions_per_sec"])
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"machine": machine, "best": best, "results": results}, f, indent=2)
+    return best
+
+if __name__ == "__main__":
+    from scripts.game_store import GameStore
+    parser = ArgumentParser(description="Pick the number of engines, threads and hash size for annotation runs")
+    parser.add_argument("--games", type=int, default=64, help="Games from the game store to sample openings from")
+    parser.add_argument("--force", action="store_true", help="Recalibrate even if this machine was calibrated before")
+    args = parser.parse_args()
+
+    store = GameStore(config.GAME_STORE_DIR)
+    games = [store.moves(idx) for idx in range(min(args.games, len(store)))]
+    best = load_or_calibrate(games, force=args.force)
+    print(f"Best: {best['engines']} engines x {best['threads']} threads, {best['hash_mb']} MB hash, "
+          f"{best['positions_per_sec']:.1f} positions/s")
@@ -0,0 +1,64 @@
+import sqlite3
+import threading
+from xiangqi import mirror_fen
+
+def canonical_fen(fen):
+    '''
+    Key under which a position is cached. The move number never influences a search so it is dropped,
+    and a position and its horizontal mirror share the lexicographically smaller of the two FENs.
+    '''
+    fen = fen.rsplit(" ", 1)[0]
+    return min(fen, mirror_fen(fen))
+
+class EvaluationCache:
+    '''
+    Persistent SQLite store of Pikafish evaluations keyed by canonical FEN and search settings,
+    so repeated positions, re-runs and incremental dataset growth never pay for the same search twice.
+    Safe to share between the threads of an EnginePool.
+    '''
+    def __init__(self, path, settings):
+        '''
+        @param path: SQLite file to create or reuse
+        @param settings: string describing the search (e.g. movetime), evaluations from other settings are never returned
+        '''
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # cp has no declared type so integers and mate strings such as M3 are stored as-is
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS evaluations ("
+            "fen TEXT NOT NULL, settings TEXT NOT NULL, cp, win REAL, draw REAL, lose REAL, "
+            "PRIMARY KEY (fen, settings)) WITHOUT ROWID"
+        )
+
+    def get(self, fen):
+        '''returns: (centipawns, win_prob, draw_prob, lose_prob) or None if the position was never searched'''
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT cp, win, draw, lose FROM evaluations WHERE fen = ? AND settings = ?",
+                (canonical_fen(fen), self.settings)
+            ).fetchone()
+        return row
+
+    def put(self, fen, evaluation):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO evaluations VALUES (?, ?, ?, ?, ?, ?)",
+                (canonical_fen(fen), self.settings, *evaluation)
+            )
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM evaluations WHERE settings = ?", (self.settings,)
+            ).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
@@ -0,0 +1,103 @@
+import os
+import re
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+CHECKPOINT_REGEX = re.compile(r"^epoch_(\d+)\.pt$")
+BEST_NAME = "best.pt"
+
+def capture_rng_state():
+    '''every random number generator training draws from, so a resumed run repeats the same shuffles, flips and dropout'''
+    return {
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        "numpy": np.random.get_state(),
+        "random": random.getstate(),
+    }
+
+def restore_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["random"])
+
+def to_cpu(obj):
+    '''copies every tensor in a nested state dict to the CPU, so training can keep updating the originals'''
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+def latest_checkpoint(directory):
+    '''returns: path of the checkpoint with the highest epoch in directory, or None'''
+    if not os.path.isdir(directory):
+        return None
+    epochs = [int(match.group(1)) for match in map(CHECKPOINT_REGEX.match, os.listdir(directory)) if match]
+    return os.path.join(directory, f"epoch_{max(epochs):04d}.pt") if epochs else None
+
+def load_checkpoint(path):
+    '''
+    Loads everything onto the CPU: torch.set_rng_state only accepts CPU tensors,
+    and load_state_dict copies model and optimizer tensors to wherever the parameters live.
+    '''
+    # checkpoints hold numpy and python RNG states next to the tensors
+    return torch.load(path, map_location="cpu", weights_only=False)
+
+class AsyncCheckpointer:
+    '''
+    Writes checkpoints from a background thread. save() only copies the state to host memory and hands it over,
+    so the training loop waits on disk only when the previous checkpoint is still being written.
+    Keeps the newest keep_last epoch checkpoints plus best.pt. Files are written to a temporary name and renamed,
+    so a crash mid-write never leaves a truncated checkpoint behind.
+    '''
+    def __init__(self, directory, keep_last=3):
+        self.directory = directory
+        self.keep_last = keep_last
+        os.makedirs(directory, exist_ok=True)
+        self.pending = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, state, epoch, is_best=False):
+        self._raise_if_failed()
+        self.pending.put((to_cpu(state), epoch, is_best))
+
+    def close(self):
+        '''waits for outstanding writes to finish'''
+        self.pending.put(None)
+        self.thread.join()
+        self._raise_if_failed()
+
+    def _raise_if_failed(self):
+        if self.error is not None:
+            raise RuntimeError("Writing a checkpoint failed") from self.error
+
+    def _write(self, state, name):
+        path = os.path.join(self.directory, name)
+        torch.save(state, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def _rotate(self):
+        epochs = sorted(int(match.group(1)) for match in map(CHECKPOINT_REGEX.match, os.listdir(self.directory)) if match)
+        # not epochs[:-keep_last], which is empty for keep_last == 0
+        for epoch in epochs[:len(epochs) - self.keep_last]:
+            os.remove(os.path.join(self.directory, f"epoch_{epoch:04d}.pt"))
+
+    def _run(self):
+        while (item := self.pending.get()) is not None:
+            state, epoch, is_best = item
+            try:
+                self._write(state, f"epoch_{epoch:04d}.pt")
+                if is_best:
+                    self._write(state, BEST_NAME)
+                self._rotate()
+            except Exception as error:
+                self.error = error
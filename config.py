@@ -9,9 +9,29 @@ PATH_TO_PIKAFISH_BINARY = os.path.expanduser("~/Pikafish/src/pikafish")
 # directory where PGN files for training and CSV of board states with annotations should be saved
 DATA_DIR = "./data"
 MODELS_DIR = "./models"
+# training metrics (JSONL) and profiler traces
+LOGS_DIR = "./logs"
+# periodic training checkpoints, see train.py --resume
+CHECKPOINTS_DIR = f"{MODELS_DIR}/checkpoints"
+# compact binary copy of the parsed PGN games
+GAME_STORE_DIR = f"{DATA_DIR}/game_store"
+# persistent cache of Pikafish evaluations shared by all annotation runs
+EVALUATION_CACHE_PATH = f"{DATA_DIR}/evaluation_cache.sqlite"
+# annotated positions are written here in shards along with a manifest of finished games, so interrupted runs can resume
+ANNOTATION_SHARDS_DIR = f"{DATA_DIR}/annotation_shards"
+# shards of runs that also label every legal move, kept apart so resuming never mixes the two kinds of run
+ACTION_VALUE_SHARDS_DIR = f"{DATA_DIR}/action_value_shards"
 # time that engine will think before producing the best move. Deepmind used 50 ms
 PIKAFISH_MOVETIME_MS = 50
-# Stockfish/Pikafish recommends num_cores * 2 - 1
-PIKAFISH_THREADS = (cpu_count() * 2 - 2) // NUM_WORKERS
+# seconds an engine may stay silent (on top of movetime) before it is considered hung and restarted
+PIKAFISH_TIMEOUT_S = 30
+# Stockfish/Pikafish recommends num_cores * 2 - 1, but every engine needs at least one thread
+PIKAFISH_THREADS = max(1, (cpu_count() * 2 - 2) // NUM_WORKERS)
+# transposition table sizes in MB tried by autotune.py, the first is Pikafish's default
+PIKAFISH_HASH_SIZES_MB = (16, 64, 256)
+# approximate memory an engine needs besides its hash table (binary, NNUE weights, thread stacks)
+PIKAFISH_BASE_MEMORY_MB = 150
+# best (engines, threads, hash) found by autotune.py on this machine
+AUTOTUNE_PATH = f"{DATA_DIR}/autotune.json"
 
 PATH_TO_NNUE="/home/prithviseri/pikafish.nnue"
\ No newline at end of file
@@ -1,34 +1,79 @@
 import torch
 import pandas as pd
 import numpy as np
+from position import positions_from_fens
 
 class AnnotatedBoardsDataset(torch.utils.data.Dataset):
-    def __init__(self, path_to_csv, tokenizer, board_flip_probability=0.0):
-        self.df = pd.read_csv(path_to_csv)
+    '''
+    Boards are parsed once into a Position array (95 bytes per board) instead of keeping the FEN strings around,
+    and tokenized per item with table lookups only.
+    '''
+    def __init__(self, path_to_csv, tokenizer):
+        # ignore game id, cp evaluation and action values
+        df = pd.read_csv(path_to_csv, usecols=["FEN", "Win_Probability", "Draw_Probability", "Lose_Probability"])
+        self.positions = positions_from_fens(df["FEN"])
+        self.wdl = df[["Win_Probability", "Draw_Probability", "Lose_Probability"]].to_numpy()
         self.tokenizer = tokenizer
-        self.board_flip_probability = board_flip_probability
-    
-    def horizontal_flip(self, fen):
-        board, metadata = fen.split(" ", 1)
-        rows = board.split("/")
-        rows_flipped = [row[::-1] for row in rows]
-        board_flipped = "/".join(rows_flipped)
-        fen_flipped = board_flipped + " " + metadata
-        return fen_flipped
 
     def __len__(self):
-        return len(self.df)
+        return len(self.positions)
     
     def __getitem__(self, idx):
-        row = self.df.iloc[idx]
-        # ignore game id and cp evaluation
-        _, fen, _, win_prob, draw_prob, lose_prob = tuple(row)
-        evaluation = np.array([win_prob, draw_prob, lose_prob])
-        evaluation = torch.from_numpy(evaluation)
-
-        if np.random.rand() <= self.board_flip_probability:
-            fen = self.horizontal_flip(fen)
+        evaluation = torch.from_numpy(self.wdl[idx])
 
-        fen_tokenized_indices = self.tokenizer.encode(fen)
+        fen_tokenized_indices = self.tokenizer.encode_positions(self.positions[idx:idx + 1])[0]
         fen_tokenized_indices = torch.from_numpy(fen_tokenized_indices)
         return fen_tokenized_indices, evaluation
+
+
+class PretokenizedBoardsDataset(torch.utils.data.Dataset):
+    '''
+    Boards tokenized ahead of time by scripts/pretokenize.py and memory mapped from .npy files,
+    so DataLoader workers share the page cache instead of each touching a pandas DataFrame.
+    Indexing with an array of indices returns a whole batch at once (use a BatchSampler with batch_size=None).
+    Tokens are returned as uint8 and should be cast to long on the training device. Augment with BoardFlip.
+    '''
+    def __init__(self, path_prefix):
+        self.tokens = np.load(f"{path_prefix}_tokens.npy", mmap_mode="r")
+        self.wdl = np.load(f"{path_prefix}_wdl.npy", mmap_mode="r")
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __getitem__(self, idx):
+        if np.isscalar(idx):
+            tokens = np.array(self.tokens[idx])
+            evaluation = np.array(self.wdl[idx])
+        else:
+            # sorted indices keep the reads from the memory map as sequential as possible
+            idx = np.sort(np.asarray(idx))
+            tokens = self.tokens[idx]
+            evaluation = self.wdl[idx]
+        return torch.from_numpy(tokens), torch.from_numpy(evaluation)
+
+class BoardFlip:
+    '''
+    Horizontal board flip augmentation for a whole batch of tokens. A flip is a fixed permutation of the
+    board tokens, so the batch is flipped with one gather and a per-board mask drawn with the given probability.
+    Can run on CPU as a DataLoader collate_fn or on the training device after the transfer.
+    '''
+    def __init__(self, tokenizer, probability):
+        self.permutation = torch.from_numpy(tokenizer.flip_permutation)
+        self.probability = probability
+
+    def __call__(self, tokens):
+        if self.probability <= 0:
+            return tokens
+        self.permutation = self.permutation.to(tokens.device)
+        flip = torch.rand(tokens.size(0), device=tokens.device) < self.probability
+        return torch.where(flip.unsqueeze(1), tokens[:, self.permutation], tokens)
+
+    def collate(self, samples):
+        '''collate_fn for loaders that fetch one sample at a time'''
+        tokens, labels = torch.utils.data.default_collate(samples)
+        return self(tokens), labels
+
+    def collate_batch(self, batch):
+        '''collate_fn for loaders whose dataset already returns whole batches (batch_size=None)'''
+        tokens, labels = batch
+        return self(tokens), labels
@@ -0,0 +1,160 @@
+import os
+import time
+import torch
+import numpy as np
+import pandas as pd
+import config
+from argparse import ArgumentParser
+from inference import add_model_args, load_model
+
+# batch sizes covered by the latency report
+BATCH_SIZES = [2 ** i for i in range(11)]
+
+class ExportedModel:
+    '''
+    Wraps an exported artifact behind one interface: call with an (N, seq_len) int64 token array,
+    get back an (N, 3) array of win/draw/lose probabilities.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        if path.endswith(".onnx"):
+            import onnxruntime
+            self.session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+            self.module = None
+        else:
+            self.session = None
+            self.module = torch.jit.load(path, map_location="cpu")
+
+    def __call__(self, tokens):
+        if self.session is not None:
+            return self.session.run(None, {"tokens": tokens})[0]
+        with torch.inference_mode():
+            return self.module(torch.from_numpy(tokens)).float().numpy()
+
+def quantize(model):
+    '''Dynamic int8 quantization of the Linear layers, activations stay in fp32'''
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def export_torchscript(model, path, seq_len):
+    example = torch.zeros(1, seq_len, dtype=torch.long)
+    # the fused encoder fast path inspects weight tensors, which quantized Linear layers do not expose
+    fastpath = torch.backends.mha.get_fastpath_enabled()
+    torch.backends.mha.set_fastpath_enabled(False)
+    try:
+        with torch.inference_mode():
+            traced = torch.jit.trace(model, example, check_trace=False)
+    finally:
+        torch.backends.mha.set_fastpath_enabled(fastpath)
+    torch.jit.save(traced, path)
+
+def export_onnx(model, path, seq_len, quantized_path=None):
+    example = torch.zeros(1, seq_len, dtype=torch.long)
+    fastpath = torch.backends.mha.get_fastpath_enabled()
+    torch.backends.mha.set_fastpath_enabled(False)
+    try:
+        torch.onnx.export(model, (example,), path, input_names=["tokens"], output_names=["wdl"],
+                          dynamic_axes={"tokens": {0: "batch"}, "wdl": {0: "batch"}}, dynamo=False)
+    finally:
+        torch.backends.mha.set_fastpath_enabled(fastpath)
+    if quantized_path is not None:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(path, quantized_path, weight_type=QuantType.QInt8)
+
+def exported_models(directory):
+    '''Loads every artifact in directory that the installed packages can run'''
+    models = list()
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith((".pt", ".onnx")):
+            continue
+        try:
+            models.append(ExportedModel(os.path.join(directory, filename)))
+        except ImportError:
+            continue
+    return models
+
+def load_fastest(directory, seq_len=97, batch_size=256, repeats=5):
+    '''
+    Times every runnable artifact in directory on a random batch and returns the fastest.
+    Note that this may pick an int8 artifact, check its accuracy first with export.py --check.
+    '''
+    tokens = np.random.randint(0, 28, size=(batch_size, seq_len)).astype(np.int64)
+    best, best_time = None, np.inf
+    for model in exported_models(directory):
+        model(tokens)
+        tick = time.perf_counter()
+        for _ in range(repeats):
+            model(tokens)
+        elapsed = time.perf_counter() - tick
+        if elapsed < best_time:
+            best, best_time = model, elapsed
+    return best
+
+def max_wdl_error(reference, candidate, tokens, batch_size=1024):
+    errors = list()
+    for start in range(0, len(tokens), batch_size):
+        batch = tokens[start:start + batch_size]
+        errors.append(np.abs(reference(batch) - candidate(batch)).max(axis=1))
+    return np.concatenate(errors)
+
+def latency_report(models, seq_len, repeats=10):
+    rows = list()
+    for model in models:
+        for batch_size in BATCH_SIZES:
+            tokens = np.random.randint(0, 28, size=(batch_size, seq_len)).astype(np.int64)
+            model(tokens)
+            timings = list()
+            for _ in range(repeats):
+                tick = time.perf_counter()
+                model(tokens)
+                timings.append(time.perf_counter() - tick)
+            latency = np.median(timings)
+            rows.append({"artifact": model.name, "batch_size": batch_size,
+                         "latency_ms": latency * 1000, "positions_per_sec": batch_size / latency})
+    return pd.DataFrame(rows)
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Export Rishi for CPU inference")
+    add_model_args(parser)
+    parser.add_argument("--out_dir", default=f"{config.MODELS_DIR}/export", help="Directory to write artifacts to")
+    parser.add_argument("--quantize", action="store_true", help="Also export dynamically int8 quantized artifacts")
+    parser.add_argument("--onnx", action="store_true", help="Also export ONNX artifacts (requires onnx, quantizing requires onnxruntime)")
+    parser.add_argument("--check", action="store_true", help="Compare every artifact against the fp32 model on the validation CSV")
+    parser.add_argument("--val_csv", default=f"{config.DATA_DIR}/val.csv", help="Positions used by --check")
+    parser.add_argument("--check_rows", type=int, default=20_000, help="Number of validation positions used by --check")
+    parser.add_argument("--tolerance", type=float, default=0.02, help="Largest allowed absolute WDL difference to fp32")
+    parser.add_argument("--report", action="store_true", help="Print latency and throughput for batch sizes 1 to 1024")
+    args = parser.parse_args()
+    args.device = "cpu"
+
+    torch.set_grad_enabled(False)
+    os.makedirs(args.out_dir, exist_ok=True)
+    model, tokenizer = load_model(args)
+
+    export_torchscript(model, f"{args.out_dir}/rishi_fp32.pt", args.max_seq_len)
+    if args.quantize:
+        export_torchscript(quantize(model), f"{args.out_dir}/rishi_int8.pt", args.max_seq_len)
+    if args.onnx:
+        quantized_path = f"{args.out_dir}/rishi_int8.onnx" if args.quantize else None
+        export_onnx(model, f"{args.out_dir}/rishi_fp32.onnx", args.max_seq_len, quantized_path)
+
+    models = exported_models(args.out_dir)
+    print("Exported " + ", ".join(model.name for model in models))
+
+    if args.check:
+        fens = pd.read_csv(args.val_csv, nrows=args.check_rows)["FEN"].tolist()
+        tokens = tokenizer.encode_batch(fens)
+        reference = lambda batch: model(torch.from_numpy(batch)).numpy()
+        failed = False
+        for candidate in models:
+            errors = max_wdl_error(reference, candidate, tokens)
+            ok = errors.max() <= args.tolerance
+            failed = failed or not ok
+            print(f"{candidate.name}: max |dWDL| {errors.max():.4f}, mean {errors.mean():.4f} over {len(tokens)} positions "
+                  f"-> {'OK' if ok else 'FAIL'}")
+        if failed:
+            raise SystemExit(f"Some artifacts differ from fp32 by more than {args.tolerance}")
+
+    if args.report:
+        print(latency_report(models, args.max_seq_len).to_string(index=False, float_format="%.2f"))
+        print(f"Fastest backend at batch size 256: {load_fastest(args.out_dir, args.max_seq_len).name}")
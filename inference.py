@@ -0,0 +1,45 @@
+import torch
+import config
+from model import TransformerClassifier
+from tokenizer import BoardTokenizer
+
+def add_model_args(parser):
+    '''Hyperparameters needed to rebuild a saved model, defaults match train.py'''
+    parser.add_argument("--model_path", default=f"{config.MODELS_DIR}/rishi.pt",
+                        help="Path to the state_dict saved by train.py")
+    parser.add_argument("--d_model", type=int, default=256,
+                        help="Transformer embedding dimension")
+    parser.add_argument("--n_heads", type=int, default=4,
+                        help="Number of attention heads per transformer layer")
+    parser.add_argument("--n_layers", type=int, default=4,
+                        help="Number of transformer encoder layers")
+    parser.add_argument("--max_seq_len", type=int, default=97,
+                        help="Maximum input sequence length")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu",
+                        help="Device to run the model on")
+
+def load_model(args):
+    '''
+    @param args: namespace with the arguments added by add_model_args
+    returns: tuple of (model in eval mode on args.device, tokenizer)
+    '''
+    tokenizer = BoardTokenizer(args.max_seq_len)
+    model = TransformerClassifier(tokenizer.vocab_size, args.max_seq_len, args.d_model, 3, args.n_layers, args.n_heads, 0.0)
+    model.load_state_dict(torch.load(args.model_path, map_location=args.device))
+    model.to(args.device).eval()
+    return model, tokenizer
+
+@torch.inference_mode()
+def evaluate_fens(model, tokenizer, fens, device="cpu"):
+    '''
+    returns: (N, 3) float array of win/draw/lose probabilities, each from the perspective of the side to move
+    '''
+    return evaluate_tokens(model, tokenizer.encode_batch(fens), device)
+
+@torch.inference_mode()
+def evaluate_tokens(model, tokens, device="cpu"):
+    '''
+    @param tokens: (N, seq_len) array of token indices from BoardTokenizer
+    returns: (N, 3) float array of win/draw/lose probabilities, each from the perspective of the side to move
+    '''
+    return model(torch.from_numpy(tokens).to(device)).float().cpu().numpy()
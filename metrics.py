@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import resource
+from contextlib import contextmanager
+import torch
+
+class StepTimer:
+    '''
+    Splits training steps into data wait, host-to-device transfer, forward/backward and optimizer step.
+    On CUDA the device is synchronized around each phase so that asynchronous kernels are charged to the phase that launched them.
+    '''
+    PHASES = ("data", "transfer", "forward_backward", "optimizer")
+
+    def __init__(self, device):
+        self.synchronize = torch.cuda.synchronize if device == "cuda" else (lambda: None)
+        self.reset()
+
+    def reset(self):
+        self.totals = dict.fromkeys(self.PHASES, 0.0)
+        self.last = dict.fromkeys(self.PHASES, 0.0)
+        self.steps = 0
+        self.samples = 0
+
+    def iterate(self, loader):
+        '''Yields the batches of loader, timing how long each one took to arrive'''
+        batches = iter(loader)
+        while True:
+            tick = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            self._add("data", time.perf_counter() - tick)
+            yield batch
+
+    @contextmanager
+    def phase(self, name):
+        self.synchronize()
+        tick = time.perf_counter()
+        yield
+        self.synchronize()
+        self._add(name, time.perf_counter() - tick)
+
+    def _add(self, name, seconds):
+        self.totals[name] += seconds
+        self.last[name] = seconds
+
+    def end_step(self, batch_size):
+        self.steps += 1
+        self.samples += batch_size
+
+    def step_record(self):
+        '''timings of the step that just ended'''
+        step_time = sum(self.last.values())
+        record = {f"{name}_ms": seconds * 1000 for name, seconds in self.last.items()}
+        record["samples_per_sec"] = self.samples / self.steps / step_time if step_time else 0.0
+        return record
+
+    def summary(self):
+        '''mean milliseconds per step and share of the step for every phase, plus overall throughput'''
+        total = sum(self.totals.values())
+        record = dict()
+        for name, seconds in self.totals.items():
+            record[f"{name}_ms"] = seconds * 1000 / max(self.steps, 1)
+            record[f"{name}_frac"] = seconds / total if total else 0.0
+        record["samples_per_sec"] = self.samples / total if total else 0.0
+        return record
+
+def peak_memory_mb(device):
+    '''peak memory allocated by tensors on CUDA, peak resident set size of the process otherwise'''
+    if device == "cuda":
+        return torch.cuda.max_memory_allocated() / 2**20
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+class MetricsLogger:
+    '''
+    Appends one JSON object per line; every record carries the run id so runs in one file can be told apart.
+    A logger without a path discards everything, which is what non-zero ranks of a distributed run use.
+    '''
+    def __init__(self, path):
+        self.file = None
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.file = open(path, "a", encoding="utf-8")
+        self.run_id = time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}"
+
+    def log(self, record_type, **fields):
+        if self.file is None:
+            return
+        record = {"run": self.run_id, "type": record_type, "time": time.time(), **fields}
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
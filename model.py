@@ -1,5 +1,8 @@
+import copy
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import numpy as np
 
 class SinusoidalPositionalEncoding(nn.Module):
@@ -19,31 +22,105 @@ class SinusoidalPositionalEncoding(nn.Module):
         x = x + self.pe[:, :seq_len, :]
         return x
 
+class SelfAttention(nn.Module):
+    def __init__(self, d_model, n_heads, dropout):
+        super(SelfAttention, self).__init__()
+        self.n_heads = n_heads
+        self.dropout = dropout
+        # parameter names and initialisation follow nn.MultiheadAttention so state dicts are interchangeable
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * d_model, d_model))
+        self.in_proj_bias = nn.Parameter(torch.zeros(3 * d_model))
+        self.out_proj = nn.Linear(d_model, d_model)
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        nn.init.zeros_(self.out_proj.bias)
+
+    def forward(self, x):
+        batch_size, seq_len, d_model = x.shape
+        qkv = F.linear(x, self.in_proj_weight, self.in_proj_bias)
+        qkv = qkv.view(batch_size, seq_len, 3, self.n_heads, d_model // self.n_heads).permute(2, 0, 3, 1, 4)
+        x = F.scaled_dot_product_attention(qkv[0], qkv[1], qkv[2], dropout_p=self.dropout if self.training else 0.0)
+        x = x.transpose(1, 2).reshape(batch_size, seq_len, d_model)
+        return self.out_proj(x)
+
+class EncoderLayer(nn.Module):
+    '''
+    Same computation and parameter names as a post-norm, batch-first nn.TransformerEncoderLayer with ReLU,
+    with attention written directly against scaled_dot_product_attention so fused kernels and torch.compile apply.
+    '''
+    def __init__(self, d_model, n_heads, dim_feedforward, dropout):
+        super(EncoderLayer, self).__init__()
+        self.self_attn = SelfAttention(d_model, n_heads, dropout)
+        self.linear1 = nn.Linear(d_model, dim_feedforward)
+        self.dropout = nn.Dropout(dropout)
+        self.linear2 = nn.Linear(dim_feedforward, d_model)
+        self.norm1 = nn.LayerNorm(d_model)
+        self.norm2 = nn.LayerNorm(d_model)
+        self.dropout1 = nn.Dropout(dropout)
+        self.dropout2 = nn.Dropout(dropout)
+
+    def forward(self, x):
+        x = self.norm1(x + self.dropout1(self.self_attn(x)))
+        x = self.norm2(x + self.dropout2(self.linear2(self.dropout(torch.relu(self.linear1(x))))))
+        return x
+
+class Encoder(nn.Module):
+    def __init__(self, d_model, n_heads, dim_feedforward, dropout, n_layers):
+        super(Encoder, self).__init__()
+        # clones of one layer, exactly like nn.TransformerEncoder, so a seed gives the same initial weights on either path
+        layer = EncoderLayer(d_model, n_heads, dim_feedforward, dropout)
+        self.layers = nn.ModuleList([copy.deepcopy(layer) for _ in range(n_layers)])
+
+    def forward(self, x):
+        for layer in self.layers:
+            x = layer(x)
+        return x
+
 class TransformerClassifier(nn.Module):
-    def __init__(self, vocab_size, max_seq_len, d_model=256, n_classes=3, n_layers=8, n_heads=8, dropout=0.1):
+    def __init__(self, vocab_size, max_seq_len, d_model=256, n_classes=3, n_layers=8, n_heads=8, dropout=0.1,
+                 fast_attention=False, activation_checkpointing=False):
+        '''
+        @param fast_attention: use EncoderLayer (scaled_dot_product_attention) instead of nn.TransformerEncoderLayer,
+                               weights load into either
+        @param activation_checkpointing: recompute each encoder layer's activations in the backward pass to save memory
+        '''
         super(TransformerClassifier, self).__init__()
         self.token_embedding = nn.Embedding(vocab_size, d_model)
         self.pos_encoding = SinusoidalPositionalEncoding(d_model, max_seq_len)
+        self.activation_checkpointing = activation_checkpointing
 
-        encoder_layer = nn.TransformerEncoderLayer(
-            d_model=d_model,
-            nhead=n_heads,
-            dim_feedforward=4*d_model,
-            dropout=dropout,
-            activation="relu",
-            batch_first=True
-        )
-        self.encoder = nn.TransformerEncoder(encoder_layer, num_layers=n_layers)
+        if fast_attention:
+            self.encoder = Encoder(d_model, n_heads, 4*d_model, dropout, n_layers)
+        else:
+            encoder_layer = nn.TransformerEncoderLayer(
+                d_model=d_model,
+                nhead=n_heads,
+                dim_feedforward=4*d_model,
+                dropout=dropout,
+                activation="relu",
+                batch_first=True
+            )
+            self.encoder = nn.TransformerEncoder(encoder_layer, num_layers=n_layers)
         self.classifier = nn.Sequential(
             nn.LayerNorm(d_model),
             nn.Linear(d_model, n_classes)
         )
     
-    def forward(self, x):
+    def forward(self, x, output="probs"):
+        '''
+        @param output: "probs" for WDL probabilities, "log_probs" for their log (what KL divergence expects) or "logits"
+        '''
         x = self.token_embedding(x)
         x = self.pos_encoding(x)
-        x = self.encoder(x)
+        if self.activation_checkpointing and self.training:
+            for layer in self.encoder.layers:
+                x = checkpoint(layer, x, use_reentrant=False)
+        else:
+            x = self.encoder(x)
         x = x.mean(dim=1)
         logits = self.classifier(x)
+        if output == "logits":
+            return logits
+        if output == "log_probs":
+            return torch.log_softmax(logits, dim=-1)
         probs = torch.softmax(logits, dim=-1)
         return probs
\ No newline at end of file
@@ -1,13 +1,119 @@
 import subprocess
 import threading
 import queue
+import time
 import re
 import config
+from xiangqi import Board
+from position import Position
+
+FEN_REGEX = re.compile(r"Fen: (.+)")
+MULTIPV_REGEX = re.compile(r" multipv (\d+)")
+# integer fields of an info line that are kept, anything else is skipped over with its value
+INFO_INT_FIELDS = frozenset(("depth", "seldepth", "multipv", "nodes", "nps"))
+INFO_SKIPPED_FIELDS = frozenset(("time", "hashfull", "tbhits", "currmovenumber", "cpuload", "currmove"))
+
+class InfoRecord:
+    '''One parsed "info" line of a search, fields the engine did not send are None'''
+    __slots__ = ("depth", "seldepth", "multipv", "nodes", "nps", "score_cp", "score_mate", "wdl", "pv")
+
+    def __init__(self, line):
+        self.depth = self.seldepth = self.nodes = self.nps = None
+        self.score_cp = self.score_mate = self.wdl = None
+        self.multipv = 1
+        self.pv = ()
+        tokens = line.split()
+        i, n = 1, len(tokens)
+        while i < n:
+            token = tokens[i]
+            if token in INFO_INT_FIELDS:
+                setattr(self, token, int(tokens[i + 1]))
+                i += 2
+            elif token == "score":
+                if tokens[i + 1] == "cp":
+                    self.score_cp = int(tokens[i + 2])
+                else:
+                    self.score_mate = int(tokens[i + 2])
+                i += 3
+            elif token == "wdl":
+                self.wdl = (int(tokens[i + 1]), int(tokens[i + 2]), int(tokens[i + 3]))
+                i += 4
+            elif token == "pv":
+                self.pv = tokens[i + 1:]
+                break
+            elif token in INFO_SKIPPED_FIELDS:
+                i += 2
+            else:
+                # lowerbound/upperbound and unknown flags
+                i += 1
+
+    def evaluation(self):
+        '''returns: tuple of centipawns (or "M<n>"/"-M<n>" for mates) and win/draw/lose probabilities'''
+        if self.score_mate is not None:
+            mate_in_n = self.score_mate
+            centipawns = f"M{mate_in_n}" if mate_in_n > 0 else f"-M{abs(mate_in_n)}"
+            # the side to move is already checkmated
+            if mate_in_n == 0:
+                return centipawns, 0.0, 0.0, 1.0
+        else:
+            centipawns = self.score_cp
+        if self.wdl is None:
+            return centipawns, None, None, None
+        win, draw, lose = self.wdl
+        return centipawns, win / 1000, draw / 1000, lose / 1000
+
+class SearchParser:
+    '''
+    Incremental parser for the output of one "go" command. feed() costs a couple of substring checks per line:
+    only the raw text of the latest scored info line is kept per MultiPV index, and it is parsed into an
+    InfoRecord once the search is over, so the hundreds of lines from earlier depths are never tokenized.
+    '''
+    __slots__ = ("latest", "bestmove", "ponder")
+
+    def __init__(self):
+        self.latest = {}
+        self.bestmove = None
+        self.ponder = None
+
+    def feed(self, line):
+        '''returns: True once the bestmove line has been seen'''
+        if line.startswith("info "):
+            if " score " in line:
+                if " multipv " in line:
+                    self.latest[int(MULTIPV_REGEX.search(line).group(1))] = line
+                else:
+                    self.latest[1] = line
+            return False
+        if line.startswith("bestmove"):
+            tokens = line.split()
+            self.bestmove = tokens[1] if len(tokens) > 1 else None
+            self.ponder = tokens[3] if len(tokens) > 3 and tokens[2] == "ponder" else None
+            return True
+        return False
+
+    def records(self):
+        '''returns: final InfoRecord of every MultiPV line, best line first'''
+        return [InfoRecord(self.latest[multipv]) for multipv in sorted(self.latest)]
+
+    def final(self):
+        '''returns: final InfoRecord of the principal variation, None if no scored line was seen'''
+        if not self.latest:
+            return None
+        return InfoRecord(self.latest[min(self.latest)])
 
 class PikafishEngine:
-    def __init__(self, threads):
+    def __init__(self, threads, timeout=None, binary=None, hash_mb=None):
+        '''
+        @param threads: number of search threads Pikafish should use
+        @param timeout: seconds to wait for a reply (on top of any think time) before raising TimeoutError, None waits forever
+        @param binary: engine executable, or a command as a list of arguments, defaults to config.PATH_TO_PIKAFISH_BINARY
+        @param hash_mb: size of the transposition table in MB, None keeps the engine's default
+        '''
+        self.threads = threads
+        self.timeout = timeout
+        binary = binary or config.PATH_TO_PIKAFISH_BINARY
         self.engine = subprocess.Popen(
-            [config.PATH_TO_PIKAFISH_BINARY],
+            [binary] if isinstance(binary, str) else list(binary),
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
@@ -34,7 +140,11 @@ class PikafishEngine:
         _ = self._wait_for("readyok")
         self.send(f"setoption name Threads value {threads}")
         _ = self._wait_for("info string Using")
+        if hash_mb is not None:
+            self.send(f"setoption name Hash value {hash_mb}")
         self.send("setoption name UCI_ShowWDL value true")
+        self.hash_mb = hash_mb
+        self.multipv = 1
         self.bestmove = None
 
     def _reader_thread(self, pipe):
@@ -45,23 +155,67 @@ class PikafishEngine:
         self.engine.stdin.write(cmd + "\n")
         self.engine.stdin.flush()
 
-    def _wait_for(self, token):
+    def _read_lines(self, token, think_time=0):
+        """Yield output lines as they arrive, the caller stops once it has seen `token`.
+        Raises TimeoutError if nothing arrives within think_time ms plus the timeout, BrokenPipeError if the engine died."""
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout + think_time / 1000
+        while True:
+            try:
+                yield self.output_queue.get(timeout=1.0)
+            except queue.Empty:
+                if self.engine.poll() is not None:
+                    raise BrokenPipeError(f"Pikafish exited with code {self.engine.returncode} while waiting for {token!r}")
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError(f"Pikafish did not reply with {token!r} within {self.timeout}s")
+
+    def _wait_for(self, token, think_time=0):
         """Block until a line containing `token` is seen; return all lines."""
         lines = []
-        while True:
-            line = self.output_queue.get()
+        for line in self._read_lines(token, think_time):
             lines.append(line)
             if token in line:
                 break
         return lines
+
+    def search(self, go_command, think_time=0):
+        '''
+        Sends a go command and parses its output as it streams in, without keeping the lines around.
+        @param go_command: e.g. "go movetime 50"
+        @param think_time: expected search time in ms, added to the timeout
+        returns: SearchParser holding the bestmove and the final info record of each MultiPV line
+        '''
+        self.send(go_command)
+        parser = SearchParser()
+        for line in self._read_lines("bestmove", think_time):
+            if parser.feed(line):
+                return parser
     
     def new_game(self):
         self.send("ucinewgame")
         self.send("isready")
         _ = self._wait_for("readyok")
 
-    def set_position(self, fen):
-        self.send(f"position fen {fen}")
+    def set_threads(self, threads):
+        '''Changes the number of search threads without restarting the engine'''
+        self.send(f"setoption name Threads value {threads}")
+        self.send("isready")
+        _ = self._wait_for("readyok")
+        self.threads = threads
+
+    def set_multipv(self, multipv):
+        '''Number of best lines reported by each search, only sent when it changes'''
+        if multipv != self.multipv:
+            self.send(f"setoption name MultiPV value {multipv}")
+            self.multipv = multipv
+
+    def set_position(self, fen, moves=()):
+        '''@param fen: FEN string or Position'''
+        if isinstance(fen, Position):
+            fen = fen.fen()
+        if moves:
+            self.send(f"position fen {fen} moves {' '.join(moves)}")
+        else:
+            self.send(f"position fen {fen}")
 
     def setup_game(self, move_history):
         moves = " ".join(move_history)
@@ -79,42 +233,46 @@ class PikafishEngine:
         self.send(f"position fen {fen} moves {moves_str}")
         self.send("d")
         lines = self._wait_for("Fen:")
-        fen = None
-        for line in lines:
-            match = re.search(r"Fen: (.+)", line)
-            if match:
-                fen = match.group(1)
-                break
-        return fen
+        return _parse_fen(lines)
 
     def is_checkmate(self, think_time):
-        self.send(f"go movetime {think_time}")
-        lines = self._wait_for("bestmove")
-        for line in lines:
-            line = line.strip()
-            if "score mate 0" in line:
-                return True
-        return False
+        record = self.search(f"go movetime {think_time}", think_time).final()
+        return record is not None and record.score_mate == 0
 
     def get_fen_after_moves(self, moves):
         self.setup_game(moves)
         self.send("d")
         lines = self._wait_for("Fen:")
-        fen = None
-        for line in lines:
-            match = re.search(r"Fen: (.+)", line)
-            if match:
-                fen = match.group(1)
-                break
-        return fen
+        return _parse_fen(lines)
 
     def get_best_move(self, think_time):
-        self.send(f"go movetime {think_time}")
-        lines = self._wait_for("bestmove")
-        for line in lines:
-            if line.startswith("bestmove"):
-                return line.split()[1]
-        return None
+        return self.search(f"go movetime {think_time}", think_time).bestmove
+
+    def find_mate(self, fen, n, max_time):
+        '''
+        Asks for a forced mate in at most n moves with a single bounded search.
+        A "score mate m" with 0 < m <= n is the engine's proof. Its PV is often cut short by hash hits,
+        so the line is only checked as far as it goes: every move must be legal, and a full length line must mate.
+        @param max_time: cap on the search in ms, the engine stops earlier once it proves the mate
+        returns: the mating line as a list of moves, possibly shorter than 2n-1 plies,
+                 or None if no mate in n was found or the PV contradicts it
+        '''
+        self.set_position(fen)
+        parser = self.search(f"go mate {n} movetime {max_time}", max_time)
+        record = parser.final()
+        if record is None or record.score_mate is None or not 0 < record.score_mate <= n:
+            return None
+        moves = record.score_mate
+        # an empty PV still has the first move of the mate in bestmove
+        line = record.pv[:2 * moves - 1] or [parser.bestmove]
+        board = Board(fen)
+        for move in line:
+            if move not in board.legal_moves():
+                return None
+            board.push(move)
+        if len(line) == 2 * moves - 1 and not board.is_checkmate():
+            return None
+        return line
 
     def evaluate(self, move_history, think_time):
         '''
@@ -126,51 +284,192 @@ class PikafishEngine:
         Evaluations are from *current* player's perspective.
         '''
         self.setup_game(move_history)
-        self.send(f"go movetime {think_time}")
-        lines = self._wait_for("bestmove")
-        centipawns, win_prob, draw_prob, lose_prob = None, None, None, None
-        for line in lines:
-            if "wdl" in line:
-                match = re.search(r"wdl (\d+) (\d+) (\d+)", line)
-                if match:
-                    win_prob = int(match.group(1)) / 1000
-                    draw_prob = int(match.group(2)) / 1000
-                    lose_prob = int(match.group(3)) / 1000
-            if "score cp" in line:
-                match = re.search(r"score cp (-?\d+)", line)
-                if match:
-                    centipawns = int(match.group(1))
-            elif "score mate" in line:
-                match = re.search(r"score mate (-?\d+)", line)
-                if match:
-                    mate_in_n = int(match.group(1))
-                    centipawns = f"M{mate_in_n}" if mate_in_n > 0 else f"-M{abs(mate_in_n)}"
-                # handle cases where we/they are already checkmated
-                if centipawns == "M0":
-                    win_prob = 1.0
-                    draw_prob = 0.0
-                    lose_prob = 0.0
-                elif centipawns == "-M0":
-                    win_prob = 0.0
-                    draw_prob = 0.0
-                    lose_prob = 1.0
-        return centipawns, win_prob, draw_prob, lose_prob
+        return _evaluation(self.search(f"go movetime {think_time}", think_time))
+
+    def annotate_moves(self, move_history, think_time, cache=None, action_values=False):
+        '''
+        @param move_history: list of moves in long algebraic notation making up a game
+        @param think_time: how long should Pikafish think before giving an evaluation?
+        @param cache: optional EvaluationCache consulted before searching and filled with new evaluations
+        @param action_values: also score every legal move, from a single MultiPV search per position.
+        The cache is not used then, it only holds single-PV evaluations
+        returns: tuple of (FENs, evaluations) for the position before each move,
+        plus a list of {move: evaluation} dicts if action_values is set
+
+        Walks the game once. FENs are computed locally, so every ply costs a single search round trip.
+        Only the moves since the last capture are replayed: the engine never looks further back
+        for repetitions, so evaluations match replaying the full history.
+        '''
+        boards = list()
+        evaluations = list()
+        move_values = list()
+        board = Board()
+        anchor_fen = board.fen()
+        moves_since_anchor = list()
+        for move in move_history:
+            fen = board.fen()
+            # a capture resets the rule 60 counter, so the new position can serve as the anchor
+            if board.rule60 == 0:
+                anchor_fen = fen
+                moves_since_anchor = list()
+            if action_values:
+                # one line per legal move, each scored from the perspective of the side to move
+                self.set_multipv(max(1, len(board.legal_moves())))
+                self.set_position(anchor_fen, moves_since_anchor)
+                parser = self.search(f"go movetime {think_time}", think_time)
+                evaluation = _evaluation(parser)
+                move_values.append({record.pv[0]: record.evaluation() for record in parser.records() if record.pv})
+            else:
+                evaluation = cache.get(fen) if cache is not None else None
+                if evaluation is None:
+                    self.set_position(anchor_fen, moves_since_anchor)
+                    evaluation = _evaluation(self.search(f"go movetime {think_time}", think_time))
+                    if cache is not None:
+                        cache.put(fen, evaluation)
+            boards.append(fen)
+            evaluations.append(evaluation)
+            board.push(move)
+            moves_since_anchor.append(move)
+        if action_values:
+            return boards, evaluations, move_values
+        return boards, evaluations
 
     def quit(self):
-        self.send("quit")
+        try:
+            self.send("quit")
+            self.engine.wait(timeout=self.timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
+
+    def kill(self):
+        self.engine.kill()
         self.engine.wait()
 
 
+class EnginePool:
+    '''
+    Pool of Pikafish engines that pull jobs from one shared queue. An idle engine always takes the next
+    job, so a run is bounded by the total amount of work rather than by its slowest fixed shard.
+    An engine that hangs or dies is restarted and its in-flight job retried.
+    '''
+    def __init__(self, size, threads, timeout=config.PIKAFISH_TIMEOUT_S, max_retries=2, binary=None, hash_mb=None):
+        self.threads = threads
+        self.binary = binary
+        self.hash_mb = hash_mb
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.engines = [None] * size
+        # (job, exception) for every job that still failed after all retries
+        self.failed = list()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def map(self, fn, jobs, key=None):
+        '''
+        @param fn: called as fn(engine, job) on whichever engine is free next
+        @param jobs: iterable of jobs
+        @param key: if given, jobs with the largest key are started first so long jobs do not straggle at the end
+        yields: (job, result) tuples in completion order
+        '''
+        jobs = sorted(jobs, key=key, reverse=True) if key is not None else list(jobs)
+        pending = queue.Queue()
+        for job in jobs:
+            pending.put(job)
+        done = queue.Queue()
+
+        workers = [
+            threading.Thread(target=self._worker, args=(slot, fn, pending, done), daemon=True)
+            for slot in range(len(self.engines))
+        ]
+        for worker in workers:
+            worker.start()
+        for _ in range(len(jobs)):
+            job, result, error = done.get()
+            if error is None:
+                yield job, result
+            else:
+                self.failed.append((job, error))
+        for worker in workers:
+            worker.join()
+
+    def _worker(self, slot, fn, pending, done):
+        while True:
+            try:
+                job = pending.get_nowait()
+            except queue.Empty:
+                return
+            for attempt in range(self.max_retries + 1):
+                try:
+                    if self.engines[slot] is None:
+                        self.engines[slot] = PikafishEngine(self.threads, timeout=self.timeout,
+                                                            binary=self.binary, hash_mb=self.hash_mb)
+                    done.put((job, fn(self.engines[slot], job), None))
+                    break
+                except (TimeoutError, OSError) as error:
+                    # engine hung or crashed, throw it away and retry the job on a fresh one
+                    if self.engines[slot] is not None:
+                        self.engines[slot].kill()
+                        self.engines[slot] = None
+                    if attempt == self.max_retries:
+                        done.put((job, None, error))
+                except Exception as error:
+                    done.put((job, None, error))
+                    break
+
+    def start(self):
+        '''
+        Starts every engine that is not running yet and waits for each to answer isready,
+        so start up and hash allocation are over before the first job. Engines are otherwise started by their first job.
+        '''
+        errors = list()
+        def start_engine(slot):
+            try:
+                if self.engines[slot] is None:
+                    self.engines[slot] = PikafishEngine(self.threads, timeout=self.timeout,
+                                                        binary=self.binary, hash_mb=self.hash_mb)
+                # setoption Hash is not acknowledged, readyok only arrives once the table is allocated
+                self.engines[slot].send("isready")
+                self.engines[slot]._wait_for("readyok")
+            except Exception as error:
+                errors.append(error)
+        starters = [threading.Thread(target=start_engine, args=(slot,), daemon=True) for slot in range(len(self.engines))]
+        for starter in starters:
+            starter.start()
+        for starter in starters:
+            starter.join()
+        if errors:
+            raise errors[0]
+
+    def set_threads(self, threads):
+        '''Reconfigures running engines and any started later, call it between map()s'''
+        self.threads = threads
+        for engine in self.engines:
+            if engine is not None:
+                engine.set_threads(threads)
+
+    def close(self):
+        for slot, engine in enumerate(self.engines):
+            if engine is not None:
+                engine.quit()
+                self.engines[slot] = None
+
+
+
+def _parse_fen(lines):
+    for line in lines:
+        match = FEN_REGEX.search(line)
+        if match:
+            return match.group(1)
+    return None
 
-def annotate_game(game, engine, think_time):
-    boards = list()
-    evaluations = list()
+def _evaluation(parser):
+    record = parser.final()
+    return record.evaluation() if record is not None else (None, None, None, None)
 
-    for ply in range(len(game.move_history)):
-        board = engine.get_fen_after_moves(game.move_history[:ply])
-        centipawns, win_prob, draw_prob, lose_prob = engine.evaluate(game.move_history[:ply], think_time)
-        evaluations.append((centipawns, win_prob, draw_prob, lose_prob))
-        boards.append(board)
-        
-    return boards, evaluations
+def annotate_game(game, engine, think_time, cache=None):
+    return engine.annotate_moves(game.move_history, think_time, cache)
 
@@ -0,0 +1,111 @@
+import re
+import numpy as np
+
+# pieces are int8 codes: 1..7 for red in this order, -1..-7 for black, 0 for an empty square
+PIECES = "KABRCNP"
+CODE_TO_CHAR = np.frombuffer(("".join(reversed(PIECES.lower())) + "." + PIECES).encode("ascii"), dtype=np.uint8)
+# ASCII code -> piece code, INVALID for characters that are not squares
+INVALID = np.int8(127)
+CHAR_TO_CODE = np.full(256, INVALID, dtype=np.int8)
+CHAR_TO_CODE[ord(".")] = 0
+for i, piece in enumerate(PIECES):
+    CHAR_TO_CODE[ord(piece)] = i + 1
+    CHAR_TO_CODE[ord(piece.lower())] = -(i + 1)
+
+NUM_SQUARES = 90
+# FEN board -> one character per square, in FEN order (rank 9 first, file a first)
+EXPAND_TABLE = str.maketrans({str(n): "." * n for n in range(1, 10)} | {"/": ""})
+EMPTY_RUN_REGEX = re.compile(r"\.+")
+
+POSITION_DTYPE = np.dtype([("board", np.int8, (NUM_SQUARES,)), ("red_to_move", np.bool_),
+                           ("rule60", np.uint16), ("fullmove", np.uint16)])
+
+def _board_codes(boards):
+    '''FEN board fields -> (N, 90) int8 piece codes with one lookup over the concatenated characters'''
+    expanded = [board.translate(EXPAND_TABLE) for board in boards]
+    for row, board in zip(expanded, boards):
+        if len(row) != NUM_SQUARES:
+            raise ValueError(f"Expected {NUM_SQUARES} squares, got {len(row)} in {board!r}")
+    codes = CHAR_TO_CODE[np.frombuffer("".join(expanded).encode("ascii"), dtype=np.uint8)].reshape(len(boards), NUM_SQUARES)
+    if (codes == INVALID).any():
+        raise ValueError("FEN board contains characters that are not pieces")
+    return codes
+
+def _board_fen(codes):
+    text = CODE_TO_CHAR[codes.astype(np.intp) + 7].tobytes().decode("ascii")
+    board = "/".join(text[i:i + 9] for i in range(0, NUM_SQUARES, 9))
+    return EMPTY_RUN_REGEX.sub(lambda m: str(len(m.group(0))), board)
+
+class Position:
+    '''
+    Compact, immutable Xiangqi position: 90 int8 piece codes in FEN order (rank 9 first), side to move and the two clocks.
+    Hashable and comparable, so it can key caches. Positions with different clocks are different positions.
+    Use positions_from_fens / to_array for many positions at once, BoardTokenizer.encode_positions to tokenize them.
+    '''
+    __slots__ = ("board", "red_to_move", "rule60", "fullmove", "_hash")
+
+    def __init__(self, board, red_to_move=True, rule60=0, fullmove=1):
+        '''
+        @param board: 90 piece codes in FEN order, copied into a read-only int8 array
+        '''
+        self.board = np.array(board, dtype=np.int8)
+        if self.board.shape != (NUM_SQUARES,):
+            raise ValueError(f"Expected {NUM_SQUARES} squares, got shape {self.board.shape}")
+        self.board.flags.writeable = False
+        self.red_to_move = bool(red_to_move)
+        self.rule60 = int(rule60)
+        self.fullmove = int(fullmove)
+        self._hash = None
+
+    @classmethod
+    def from_fen(cls, fen):
+        board, turn, _, _, rule60, fullmove = fen.split(" ")
+        return cls(_board_codes([board])[0], turn == "w", int(rule60), int(fullmove))
+
+    @classmethod
+    def from_record(cls, record):
+        '''@param record: one element of an array with POSITION_DTYPE'''
+        return cls(record["board"], record["red_to_move"], record["rule60"], record["fullmove"])
+
+    def fen(self):
+        return f"{_board_fen(self.board)} {'w' if self.red_to_move else 'b'} - - {self.rule60} {self.fullmove}"
+
+    def mirror(self):
+        '''Flips the board left to right, see xiangqi.mirror_fen'''
+        return Position(self.board.reshape(10, 9)[:, ::-1].ravel(), self.red_to_move, self.rule60, self.fullmove)
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash((self.board.tobytes(), self.red_to_move, self.rule60, self.fullmove))
+        return self._hash
+
+    def __eq__(self, other):
+        if not isinstance(other, Position):
+            return NotImplemented
+        return (self.red_to_move == other.red_to_move and self.rule60 == other.rule60
+                and self.fullmove == other.fullmove and np.array_equal(self.board, other.board))
+
+    def __repr__(self):
+        return f"Position({self.fen()!r})"
+
+def to_array(positions):
+    '''returns: structured array with POSITION_DTYPE holding the given Positions'''
+    array = np.empty(len(positions), dtype=POSITION_DTYPE)
+    for i, position in enumerate(positions):
+        array[i] = (position.board, position.red_to_move, position.rule60, position.fullmove)
+    return array
+
+def positions_from_fens(fens):
+    '''returns: structured array with POSITION_DTYPE, parsed without creating a Position per FEN'''
+    fields = [fen.split(" ") for fen in fens]
+    array = np.empty(len(fields), dtype=POSITION_DTYPE)
+    if not fields:
+        return array
+    array["board"] = _board_codes([field[0] for field in fields])
+    array["red_to_move"] = [field[1] == "w" for field in fields]
+    array["rule60"] = [int(field[4]) for field in fields]
+    array["fullmove"] = [int(field[5]) for field in fields]
+    return array
+
+def fens_from_array(array):
+    return [Position.from_record(record).fen() for record in array]
@@ -1,99 +1,201 @@
 import pandas as pd
-from oracle import PikafishEngine
+from oracle import PikafishEngine, EnginePool
+import numpy as np
+from xiangqi import Board
 import config
 import time
 import os
 from argparse import ArgumentParser
 
+PUZZLES_PATH = os.path.expanduser("~/Rishi/data/puzzles_data_5000.csv")
 SUMMARY_DIR = os.path.expanduser("~/Rishi/data/puzzle_sweeps")
+RESULTS = ("Success", "Success(Alternate Solution)", "Fail")
 
-#For puzzle test sweep using Slurm
-def write_summary_row(thinktime, numThreads, success, alt_success, fail, elapsed):
-    os.makedirs(SUMMARY_DIR, exist_ok=True)
-    total = success + alt_success + fail
-    acc = (success + alt_success) / total * 100 if total else 0.0
-    # unique file per combo
-    out = os.path.join(SUMMARY_DIR, f"summary_tt{thinktime}_th{numThreads}.csv")
-    pd.DataFrame([{
-        "thinktime_ms": thinktime,
-        "threads": numThreads,
-        "success": success,
-        "alt_success": alt_success,
-        "fail": fail,
-        "total": total,
-        "accuracy_pct": acc,
-        "elapsed_sec": elapsed
-    }]).to_csv(out, index=False)
+#Read the puzzle csv once and turn every puzzle into its starting fen and solution
+def load_puzzles(path = PUZZLES_PATH):
+    df = pd.read_csv(path)
+    puzzles = []
+    for pid, group in df.groupby("puzzle_id", sort=False):
+        group = group.sort_values("index", kind="stable")
+        preset = group.loc[~group["is_solution_move"], "move"].tolist()
+        puzzles.append({
+            "pid": pid,
+            "category": group["category"].iloc[0],
+            #Only applies to our current puzzle set since everything is "Mate in N" puzzles
+            "mate_in": int(group["category"].iloc[0][-1:]),
+            "fen": Board().push_moves(preset).fen(),
+            "solution": group.loc[group["is_solution_move"], "move"].tolist(),
+        })
+    return puzzles
 
-#Test all puzzles
-def Full_Puzzle_Test(save_results = False, thinktime = 50, numThreads = 8):
-    #Read csv
-    file_dir = "~/Rishi/data/puzzles_data_5000.csv"
-    df = pd.read_csv(file_dir)
+#Solve one puzzle on whichever engine of the pool is free
+def Grade_Puzzle(engine, puzzle, thinktime):
+    engine.new_game()
+    if Solve_Puzzle(engine, puzzle["fen"], puzzle["solution"], puzzle["mate_in"], thinktime):
+        return "Success"
+    if Check_Alternate_Answer(engine, puzzle["fen"], puzzle["mate_in"], thinktime):
+        return "Success(Alternate Solution)"
+    return "Fail"
 
-    #Start engine
-    engine = PikafishEngine(threads=numThreads)
-    Success = 0
-    Alternate_Success = 0
-    Fail = 0
-    Puzzle_Count = 1
+#One table for the whole sweep, one row per thinktime/threads setting
+def write_summary(rows, out_path):
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    pd.DataFrame(rows).to_csv(out_path, index=False)
+
+#Test all puzzles for every thinktime x threads setting
+#Settings run one after another on the same pool, the puzzles of a setting are spread over all its engines.
+#They are not merged into one map over (puzzle, thinktime) jobs because each row reports the setting's own wall time
+#and puzzles/s, which only mean something if nothing else runs on the engines meanwhile.
+#Engines are started (and reconfigured) before the clock runs, so start up is not charged to the first setting
+def Full_Puzzle_Test(save_results = False, thinktimes = (50,), threads = (8,), workers = 1, puzzles_path = PUZZLES_PATH,
+                     summary_path = os.path.join(SUMMARY_DIR, "summary.csv")):
+    puzzles = load_puzzles(puzzles_path)
+    summary = []
     results = []
-    start_time = time.time()
 
-    #For each puzzle, generate fen
-    #Then, calculate answers
-    for pid, group in df.groupby("puzzle_id"):
-        group = group.sort_values("index", kind="stable")
-        engine.new_game()
-        preset = group.loc[~group["is_solution_move"], "move"].tolist()
-        solution = group.loc[group["is_solution_move"], "move"].tolist()
-        #Only applies to our current puzzle set since everything is "Mate in N" puzzles
-        category = int(group["category"].iloc[0][-1:])
-
-        fen = engine.get_fen_after_moves(preset)
-
-        puzzle_solved = Solve_Puzzle(engine,fen,solution,category,thinktime)
-
-        result_log = "Puzzle "+ str(Puzzle_Count) + " | pid = " + pid #+ " | category = " + group["category"].iloc[0]
-
-        if(puzzle_solved): 
-            Success += 1
-            print(result_log + " | Success")
-            results.append({"puzzle_index": Puzzle_Count, "pid": pid, "category": group["category"].iloc[0], "result": "Success"})
-        elif(Check_Alternate_Answer(engine,fen,category,thinktime)):
-            Alternate_Success += 1
-            print(result_log + " | Success(Alternate Solution)")
-            results.append({"puzzle_index": Puzzle_Count, "pid": pid, "category": group["category"].iloc[0], "result": "Success(Alternate Solution)"})
-        else: 
-            Fail += 1
-            print(result_log + " | Fail")
-            results.append({"puzzle_index": Puzzle_Count, "pid": pid, "category": group["category"].iloc[0], "result": "Fail"})
-        Puzzle_Count += 1
-    
-    elapsed = str(time.time()-start_time)
+    with EnginePool(workers, threads[0]) as pool:
+        pool.start()
+        for numThreads in threads:
+            pool.set_threads(numThreads)
+            pool.start()
+            for thinktime in thinktimes:
+                counts = dict.fromkeys(RESULTS, 0)
+                pool.failed = []
+                start_time = time.time()
+                #Longest puzzles first so they do not straggle at the end
+                for puzzle, result in pool.map(lambda engine, puzzle: Grade_Puzzle(engine, puzzle, thinktime),
+                                               puzzles, key=lambda puzzle: puzzle["mate_in"]):
+                    counts[result] += 1
+                    print("pid = " + puzzle["pid"] + " | tt = " + str(thinktime) + " | th = " + str(numThreads) + " | " + result)
+                    results.append({"pid": puzzle["pid"], "category": puzzle["category"],
+                                    "thinktime_ms": thinktime, "threads": numThreads, "result": result})
+                elapsed = time.time() - start_time
 
-    print("Success : "+ str(Success))
-    print("Alternate Success : "+ str(Alternate_Success))
-    print("Fail : "+ str(Fail))
-    print("Accuracy : " + str((Success+Alternate_Success)/(Success+Alternate_Success+Fail)*100) + "%")
-    print("Elapsed Time : " + elapsed + "s")
+                success, alt_success, fail = (counts[result] for result in RESULTS)
+                total = success + alt_success + fail
+                #Engine errors (hangs that outlived every retry) are not counted as solved or failed
+                summary.append({
+                    "engine": "pikafish",
+                    "thinktime_ms": thinktime,
+                    "threads": numThreads,
+                    "workers": workers,
+                    "success": success,
+                    "alt_success": alt_success,
+                    "fail": fail,
+                    "errors": len(pool.failed),
+                    "total": total,
+                    "accuracy_pct": (success + alt_success) / total * 100 if total else 0.0,
+                    "elapsed_sec": elapsed,
+                    "puzzles_per_sec": total / elapsed if elapsed else 0.0,
+                })
+                for puzzle, error in pool.failed:
+                    print("pid = " + puzzle["pid"] + " | Error : " + repr(error))
+
+    table = pd.DataFrame(summary)
+    print(table.to_string(index=False, float_format="%.2f"))
+    write_summary(summary, summary_path)
 
     if(save_results):
         out_path = os.path.expanduser("~/Rishi/data/pikafish_puzzle_results.csv")
         pd.DataFrame(results).to_csv(out_path, index=False)
-    
-    write_summary_row(thinktime, numThreads, Success, Alternate_Success, Fail, elapsed)
-    engine.quit()
+    return table
+
+#Pick the model's move in every board at once: all children of all boards go through batched forward passes
+def Model_Best_Moves(model, tokenizer, device, boards, batch_size):
+    from inference import evaluate_fens
+    moves = [board.legal_moves() for board in boards]
+    children = [board.copy().push_moves([move]).fen() for board, legal in zip(boards, moves) for move in legal]
+    wdl = np.concatenate([evaluate_fens(model, tokenizer, children[i:i + batch_size], device)
+                          for i in range(0, len(children), batch_size)]) if children else np.zeros((0, 3))
+    best_moves = []
+    start = 0
+    for legal in moves:
+        if not legal:
+            best_moves.append(None)
+            continue
+        # child evaluations are from the opponent's perspective, so pick the move that leaves them most likely to lose
+        best_moves.append(legal[int(wdl[start:start + len(legal), 2].argmax())])
+        start += len(legal)
+    return best_moves
+
+#Solve all puzzles with the searchless model, every unfinished puzzle advances one ply per round
+#Follows the solution while the model agrees with it, like Grade_Puzzle, but alternate solutions are graded differently:
+#Pikafish has to prove a forced mate in N with a "go mate" search (Check_Alternate_Answer), while the model has no search,
+#so it plays both sides from the puzzle position and a checkmate within N of its own moves counts.
+#The model also picks the defence, so its alternate solutions are a weaker claim than Pikafish's
+def Model_Puzzle_Test(model_args, save_results = False, puzzles_path = PUZZLES_PATH, batch_size = 4096,
+                      summary_path = os.path.join(SUMMARY_DIR, "model_summary.csv")):
+    import torch
+    from inference import load_model
+    puzzles = load_puzzles(puzzles_path)
+    model, tokenizer = load_model(model_args)
+    start_time = time.time()
+
+    states = [{"puzzle": puzzle, "board": Board(puzzle["fen"]), "ply": 0, "alternate": False} for puzzle in puzzles]
+    results = {}
+    active = states
+    while active:
+        best_moves = Model_Best_Moves(model, tokenizer, model_args.device, [state["board"] for state in active], batch_size)
+        for state, best_move in zip(active, best_moves):
+            puzzle, board, ply = state["puzzle"], state["board"], state["ply"]
+            if not state["alternate"]:
+                solution = puzzle["solution"]
+                if best_move != solution[ply]:
+                    #Replay from the start with the model on both sides
+                    state.update(board=Board(puzzle["fen"]), ply=0, alternate=True)
+                    continue
+                #Opponent replies with the solution's move, no forward pass needed
+                board.push_moves(solution[ply:ply + 2])
+                state["ply"] = ply + 2
+                if state["ply"] >= len(solution):
+                    results[puzzle["pid"]] = "Success"
+            elif best_move is None:
+                results[puzzle["pid"]] = "Fail"
+            else:
+                board.push(best_move)
+                state["ply"] = ply + 1
+                #Mating early still counts
+                if ply % 2 == 0 and board.is_checkmate():
+                    results[puzzle["pid"]] = "Success(Alternate Solution)"
+                elif ply // 2 + 1 >= puzzle["mate_in"] and ply % 2 == 0:
+                    results[puzzle["pid"]] = "Fail"
+        active = [state for state in active if state["puzzle"]["pid"] not in results]
+    elapsed = time.time() - start_time
+
+    counts = {result: sum(1 for value in results.values() if value == result) for result in RESULTS}
+    success, alt_success, fail = (counts[result] for result in RESULTS)
+    total = success + alt_success + fail
+    summary = [{
+        "engine": "rishi",
+        "thinktime_ms": None,
+        "threads": torch.get_num_threads(),
+        "workers": 1,
+        "success": success,
+        "alt_success": alt_success,
+        "fail": fail,
+        "errors": 0,
+        "total": total,
+        "accuracy_pct": (success + alt_success) / total * 100 if total else 0.0,
+        "elapsed_sec": elapsed,
+        "puzzles_per_sec": total / elapsed if elapsed else 0.0,
+    }]
+    table = pd.DataFrame(summary)
+    print(table.to_string(index=False, float_format="%.2f"))
+    write_summary(summary, summary_path)
+
+    if(save_results):
+        out_path = os.path.expanduser("~/Rishi/data/rishi_puzzle_results.csv")
+        pd.DataFrame([{"pid": puzzle["pid"], "category": puzzle["category"], "result": results[puzzle["pid"]]}
+                      for puzzle in puzzles]).to_csv(out_path, index=False)
+    return table
 
 #Test 1 puzzle using given puzzle id
-def Puzzle_Test(pid, thinktime = 50, numThreads = 8):
+def Puzzle_Test(pid, thinktime = 50, numThreads = 8, puzzles_path = PUZZLES_PATH):
     #Read csv
-    file_dir = "~/Rishi/data/puzzles_data_5000.csv"
-    df = pd.read_csv(file_dir)
+    df = pd.read_csv(puzzles_path)
 
     #Start engine
     engine = PikafishEngine(threads=numThreads)
-    start_time = time.time()
 
     puzzle = df[df["puzzle_id"] == pid].copy()
     if puzzle.empty:
@@ -106,14 +208,14 @@ def Puzzle_Test(pid, thinktime = 50, numThreads = 8):
     #Only applies to our current puzzle set since everything is "Mate in N" puzzles
     category = int(puzzle["category"].iloc[0][-1:])
 
-    fen = engine.get_fen_after_moves(preset)
+    fen = Board().push_moves(preset).fen()
     print(fen)
     
     puzzle_solved = Solve_Puzzle(engine,fen,solution,category,thinktime,True)
     print(category)
 
     if(puzzle_solved): print("Success")
-    elif(Check_Alternate_Answer(engine,fen,category,thinktime)): print("Success(Alternate Solution)")
+    elif(mating_line := Check_Alternate_Answer(engine,fen,category,thinktime)): print("Success(Alternate Solution) : " + " ".join(mating_line))
     else:print("Fail")
         
     engine.quit()
@@ -134,45 +236,57 @@ def Solve_Puzzle(engine,fen,solution,category, thinktime, single_test = False):
         if best_move != solution[i]:
             puzzle_solved = False
             break
-        engine.play_moves(fen,tuple(solution[:i+2]))
+        engine.set_position(fen,solution[:i+2])
      
     return puzzle_solved
 
-#Check if Pikafish's answer is still Mate in N
+#Check if Pikafish can still force mate in N from the puzzle position, returns the mating line or None
+#One bounded mate search replaces playing out 2N-1 timed searches, the (possibly shortened) line is checked on the board
 def Check_Alternate_Answer(engine,fen,category,thinktime):
     engine.new_game()
-    engine.set_position(fen)
-    for i in range(category):
-        best_move = engine.get_best_move(thinktime)
-        fen = engine.play_moves(fen,[best_move])
-        #Opponent's optimal move
-        if i!=category-1:
-            best_move = engine.get_best_move(thinktime)
-            fen = engine.play_moves(fen,[best_move])
-    return engine.is_checkmate(thinktime)
+    #Never search longer than the play-out it replaces could have taken
+    return engine.find_mate(fen, category, thinktime * (2 * category - 1))
 
 #No arg : run all without saving
 #-s : run all and save results in csv
 #-t : for running all tests with given thinktime and threads
+#--thinktimes/--threads : sweep every combination in one run
+#--model : solve all puzzles with the trained model instead of Pikafish
 #-p puzzle_id : run just that puzzle printint each move
 def main():
+    #The model arguments (and torch) are only needed with --model, Pikafish runs never import them
+    pre_parser = ArgumentParser(add_help=False)
+    pre_parser.add_argument("--model", action="store_true")
+    use_model = pre_parser.parse_known_args()[0].model
+
     parser = ArgumentParser(description="Pikafish puzzle solver")
     parser.add_argument("-s", "--save", action="store_true", help="solve all puzzles")
     parser.add_argument("-t", "--test", nargs=2, type=int, metavar=("thinktime", "numThreads"), help="run without saving; requires THINKTIME_MS and THREADS")
+    parser.add_argument("--thinktimes", nargs="+", type=int, default=[50], help="think times in ms to sweep")
+    parser.add_argument("--threads", nargs="+", type=int, default=[8], help="Pikafish thread counts to sweep")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="number of engines solving puzzles in parallel")
+    parser.add_argument("--puzzles", default=PUZZLES_PATH, help="puzzle csv")
+    parser.add_argument("--summary", help="where to write the per-setting results table, defaults to summary.csv or model_summary.csv in " + SUMMARY_DIR)
+    parser.add_argument("--model", action="store_true", help="solve the puzzles with the searchless model, --model -h lists the model options")
+    parser.add_argument("--batch_size", type=int, default=4096, help="positions per forward pass in --model mode")
+    if use_model:
+        from inference import add_model_args
+        add_model_args(parser)
     parser.add_argument("-p", "--puzzle-id", dest="puzzle_id", help="solve a single puzzle_id")
     args = parser.parse_args()
 
+    thinktimes, threads = args.thinktimes, args.threads
+    if args.test:
+        thinktimes, threads = [args.test[0]], [args.test[1]]
+    if min(thinktimes) <= 0 or min(threads) <= 0 or args.workers <= 0:
+        raise ValueError("THINKTIME_MS, THREADS and WORKERS must be positive integers.")
+
     if args.puzzle_id:
-        Puzzle_Test(args.puzzle_id)
-    elif args.save:
-        Full_Puzzle_Test(True)
-    elif args.test:
-        thinktime, numThreads = args.test  
-        if thinktime <= 0 or numThreads <= 0:
-            raise ValueError("THINKTIME_MS and THREADS must be positive integers.")
-        Full_Puzzle_Test(False, thinktime, numThreads)
+        Puzzle_Test(args.puzzle_id, thinktimes[0], threads[0], args.puzzles)
+    elif args.model:
+        Model_Puzzle_Test(args, args.save, args.puzzles, args.batch_size, args.summary or os.path.join(SUMMARY_DIR, "model_summary.csv"))
     else:
-        Full_Puzzle_Test() 
+        Full_Puzzle_Test(args.save, thinktimes, threads, args.workers, args.puzzles, args.summary or os.path.join(SUMMARY_DIR, "summary.csv"))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,87 +1,66 @@
 import subprocess
-from scripts.game import Game
-import re
-from oracle import annotate_game, PikafishEngine
+from scripts.game_store import GameStore, build_store, is_up_to_date
+from oracle import EnginePool
+from cache import EvaluationCache
+from shards import ShardWriter, completed_games, merge_shards
 import config
 from tqdm import tqdm
-from multiprocessing import Pool
-import os
-import shutil
-import math
+from argparse import ArgumentParser
+
+parser = ArgumentParser(description="Annotate all PGN games with Pikafish evaluations")
+parser.add_argument("--autotune", action="store_true",
+                    help="Size engines, threads and hash to this machine (see autotune.py) instead of using config.NUM_WORKERS and config.PIKAFISH_THREADS")
+parser.add_argument("--action_values", action="store_true",
+                    help="Also store the score and WDL of every legal move from one MultiPV search per position, in an extra Action_Values column")
+args = parser.parse_args()
+shards_dir = config.ACTION_VALUE_SHARDS_DIR if args.action_values else config.ANNOTATION_SHARDS_DIR
 
 # extract all PGN game files
 result = subprocess.run(f"find {config.DATA_DIR} -type f -name '*.pgns'", shell=True, check=True, capture_output=True)
 filenames = result.stdout.decode('utf-8').splitlines()
 
-games = list()
-for filename in filenames:
-    with open(filename, encoding='utf-8') as f:
-        contents = f.read()
-    
-    games_info = [game_info.strip() for game_info in contents.split('\n\n') if game_info.strip()]
-
+# games are parsed once into a compact binary store, which is rebuilt only when the PGN files change
+if not is_up_to_date(config.GAME_STORE_DIR, filenames):
     print("Importing PGN files...")
-    for game_info in tqdm(games_info):
-        # extract metadata such as player names and event date
-        metadata_matches = re.findall(r'^\[(\w+)\s+"(.*?)"\]$', game_info, flags=re.MULTILINE)
-        metadata = {key: value for key, value in metadata_matches}
-
-        # converts move history from more human readable format -> simple list of long algebraic moves
-        moves_text = re.sub(r'^\[.*\]$', '', game_info, flags=re.MULTILINE)
-        moves_text = re.sub(r'\d+-\d+$', '', moves_text, flags=re.MULTILINE)
-        moves = re.findall(r'\b([A-I0-9]+-[A-I0-9]+)\b', moves_text)
-        moves = [m.lower().replace('-', '') for m in moves]
+    build_store(filenames, config.GAME_STORE_DIR)
+store = GameStore(config.GAME_STORE_DIR)
 
-        # dirty hack to trim off stray numbers that get appended, fix the regex later
-        if(moves[-1].isdigit()):
-            moves = moves[:-1]
-        
-        game = Game(moves, *metadata.values())
-        games.append(game)
+# games finished by an earlier, interrupted run are already in the shards
+done = completed_games(shards_dir)
+remaining = [idx for idx in range(len(store)) if store.ids[idx] not in done]
+print(f"Starting annotations ({len(store) - len(remaining)} of {len(store)} games already annotated)...")
 
-print("Starting annotations...")
+def annotate(engine, idx):
+    engine.new_game()
+    return engine.annotate_moves(store.moves(idx), think_time=config.PIKAFISH_MOVETIME_MS, cache=cache,
+                                 action_values=args.action_values)
 
-def worker(args):
-    indices, me = args
-    engine = PikafishEngine(threads=config.PIKAFISH_THREADS)
+num_workers, threads, hash_mb = config.NUM_WORKERS, config.PIKAFISH_THREADS, None
+if args.autotune:
+    from autotune import load_or_calibrate
+    sample = [store.moves(idx) for idx in remaining[:64]] or [store.moves(0)]
+    best = load_or_calibrate(sample)
+    num_workers, threads, hash_mb = best["engines"], best["threads"], best["hash_mb"]
+    print(f"Using {num_workers} engines x {threads} threads with {hash_mb} MB hash")
 
-    out_path = os.path.join(config.DATA_DIR, f"annotated_worker_{me}.csv")
-    with open(out_path, "w", encoding="utf-8") as f:
-        f.write("Game ID,FEN,CP,Win_Probability,Draw_Probability,Lose_Probability\n")
-        for idx in indices:
-            game = games[idx]
-            engine.new_game()
-            boards, evaluations = annotate_game(game, engine=engine,
-                                          think_time=config.PIKAFISH_MOVETIME_MS)
-            for fen, evaluation in zip(boards, evaluations):
-                cp, win, draw, loss = evaluation
-                f.write(f"{game.id},{fen},{cp},{win},{draw},{loss}\n")
-            f.flush()
-    engine.quit()
-    return out_path
+# positions already searched with the same settings in this or an earlier run are not searched again.
+# threads and hash size change what a fixed movetime search finds, so they are part of the settings
+cache = EvaluationCache(config.EVALUATION_CACHE_PATH,
+                        settings=f"movetime {config.PIKAFISH_MOVETIME_MS} threads {threads} hash {hash_mb or 'default'}")
 
-n = len(games)
-batch_size = math.ceil(n / config.NUM_WORKERS)
-batches = [
-    (range(i*batch_size, min((i+1)*batch_size, n)), i)
-    for i in range(config.NUM_WORKERS)
-]
+# engines pull one game index at a time, longest first, and results are sharded as they arrive
+lengths = store.lengths()
+with EnginePool(num_workers, threads, hash_mb=hash_mb) as pool, ShardWriter(shards_dir, action_values=args.action_values) as writer:
+    annotated = pool.map(annotate, remaining, key=lambda idx: lengths[idx])
+    for idx, annotation in tqdm(annotated, total=len(remaining)):
+        writer.add_game(store.ids[idx], *annotation)
+        cache.commit()
+cache.close()
 
-with Pool(config.NUM_WORKERS) as pool:
-    # each worker writes directly to its own CSV file
-    partial_files = list(tqdm(pool.imap_unordered(worker, batches), total=config.NUM_WORKERS))
+for idx, error in pool.failed:
+    print(f"Failed to annotate game {store.ids[idx]}: {error!r}")
 
+# combine results of all runs
 aggregated_path = f"{config.DATA_DIR}/annotated_games.csv"
-
-# combine results of workers
-with open(aggregated_path, "w", encoding="utf-8") as fout:
-    fout.write("Game ID,FEN,CP,Win_Probability,Draw_Probability,Lose_Probability\n")
-
-    for tmp_path in partial_files:
-        with open(tmp_path, "r", encoding="utf-8") as fin:
-            next(fin)
-            shutil.copyfileobj(fin, fout)
-
-# cleanup
-for f in partial_files:
-    os.remove(f)
\ No newline at end of file
+n_positions = merge_shards(shards_dir, aggregated_path)
+print(f"Wrote {n_positions} positions to {aggregated_path}")
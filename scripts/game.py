@@ -4,7 +4,9 @@ class Game:
     def __init__(self, move_history, game_type="Chinese Chess", event=None, site=None, date=None, round_num=None, red_team=None, 
                  red=None, black_team=None, black=None, result=None, opening=None, 
                  startpos_fen="rnbakabnr/9/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RNBAKABNR w - - 0 1", move_format=None):
-        self.id = shortuuid.uuid()
+        # derived from the game itself so the same game keeps its id across runs, which resuming annotation relies on
+        self.id = shortuuid.uuid(name="|".join([" ".join(move_history), str(event), str(site), str(date), str(round_num),
+                                                str(red), str(black), str(result)]))
         self.game = game_type
         self.event = event
         self.site = site
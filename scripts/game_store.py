@@ -0,0 +1,112 @@
+import os
+import re
+import json
+import numpy as np
+from multiprocessing import Pool
+from scripts.game import Game
+from xiangqi import parse_move, move_name
+
+METADATA_REGEX = re.compile(r'^\[(\w+)\s+"(.*?)"\]$', flags=re.MULTILINE)
+TAG_REGEX = re.compile(r'^\[.*\]$', flags=re.MULTILINE)
+# a move is exactly one file letter and rank digit on each side, so results such as 1-0 never match
+MOVE_REGEX = re.compile(r'\b([A-I]\d)-([A-I]\d)\b')
+
+def read_pgn_games(filenames):
+    '''Yields the text of one game at a time, games being separated by blank lines'''
+    for filename in filenames:
+        with open(filename, encoding='utf-8') as f:
+            lines = list()
+            for line in f:
+                if line.strip():
+                    lines.append(line)
+                elif lines:
+                    yield "".join(lines)
+                    lines = list()
+            if lines:
+                yield "".join(lines)
+
+def parse_game(game_info):
+    '''
+    returns: (moves as uint16 from << 8 | to square codes, PGN tags, game id) or None for a game without moves
+    '''
+    # extract metadata such as player names and event date
+    metadata = {key: value for key, value in METADATA_REGEX.findall(game_info)}
+    # converts move history from more human readable format -> simple list of long algebraic moves
+    moves = [(start + end).lower() for start, end in MOVE_REGEX.findall(TAG_REGEX.sub('', game_info))]
+    if not moves:
+        return None
+    game = Game(moves, *metadata.values())
+    codes = np.array([(from_sq << 8) | to_sq for from_sq, to_sq in map(parse_move, moves)], dtype=np.uint16)
+    return codes, metadata, game.id
+
+def _sources(filenames):
+    return [[filename, os.path.getsize(filename), os.path.getmtime(filename)] for filename in sorted(filenames)]
+
+def is_up_to_date(directory, filenames):
+    '''Has the store in directory been built from exactly these PGN files, unchanged since?'''
+    path = os.path.join(directory, "sources.json")
+    if not os.path.exists(path):
+        return False
+    with open(path, encoding="utf-8") as f:
+        return json.load(f) == _sources(filenames)
+
+def build_store(filenames, directory, processes=None):
+    '''
+    Parses PGN files in parallel, streaming games through a process pool, and writes them once as:
+    moves.bin (uint16 move codes of all games back to back), offsets.npy (start of each game in moves.bin),
+    ids.npy (game ids) and games.jsonl (PGN tags, one line per game).
+    '''
+    os.makedirs(directory, exist_ok=True)
+    sources_path = os.path.join(directory, "sources.json")
+    if os.path.exists(sources_path):
+        os.remove(sources_path)
+
+    offsets = [0]
+    ids = list()
+    with Pool(processes) as pool, \
+            open(os.path.join(directory, "moves.bin"), "wb") as moves_file, \
+            open(os.path.join(directory, "games.jsonl"), "w", encoding="utf-8") as metadata_file:
+        for parsed in pool.imap(parse_game, read_pgn_games(filenames), chunksize=256):
+            if parsed is None:
+                continue
+            codes, metadata, game_id = parsed
+            moves_file.write(codes.tobytes())
+            metadata_file.write(json.dumps(metadata) + "\n")
+            offsets.append(offsets[-1] + len(codes))
+            ids.append(game_id)
+
+    np.save(os.path.join(directory, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(directory, "ids.npy"), np.array(ids))
+    # written last, so a store is only ever considered complete once everything else is on disk
+    with open(sources_path, "w", encoding="utf-8") as f:
+        json.dump(_sources(filenames), f)
+    return len(ids)
+
+class GameStore:
+    '''
+    Read-only view of a store written by build_store. Moves are memory mapped and decoded only
+    for the games that are asked for, so passing indices around is all workers need.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"))
+        self.ids = np.load(os.path.join(directory, "ids.npy"))
+        moves_path = os.path.join(directory, "moves.bin")
+        self.codes = np.memmap(moves_path, dtype=np.uint16, mode="r") if os.path.getsize(moves_path) else np.zeros(0, np.uint16)
+        self._metadata = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def moves(self, idx):
+        codes = self.codes[self.offsets[idx]:self.offsets[idx + 1]]
+        return [move_name(code >> 8, code & 0xFF) for code in codes.tolist()]
+
+    def game(self, idx):
+        if self._metadata is None:
+            with open(os.path.join(self.directory, "games.jsonl"), encoding="utf-8") as f:
+                self._metadata = [json.loads(line) for line in f]
+        return Game(self.moves(idx), *self._metadata[idx].values())
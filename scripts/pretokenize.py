@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+import config
+from tokenizer import BoardTokenizer
+from tqdm import tqdm
+from argparse import ArgumentParser
+
+# converts the train/val/test CSVs into memory mapped token and WDL matrices for PretokenizedBoardsDataset
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Pre-tokenize annotated board CSVs")
+    parser.add_argument("--splits", nargs="+", default=["train", "val", "test"],
+                        help="Names of the CSVs in DATA_DIR to convert")
+    parser.add_argument("--max_seq_len", type=int, default=97,
+                        help="Tokenized FEN length")
+    parser.add_argument("--chunksize", type=int, default=100_000,
+                        help="Rows read from the CSV at a time")
+    args = parser.parse_args()
+
+    tokenizer = BoardTokenizer(args.max_seq_len)
+    for split in args.splits:
+        csv_path = f"{config.DATA_DIR}/{split}.csv"
+        with open(csv_path, encoding="utf-8") as f:
+            n = sum(1 for _ in f) - 1
+
+        tokens = np.lib.format.open_memmap(f"{config.DATA_DIR}/{split}_tokens.npy", mode="w+",
+                                           dtype=np.uint8, shape=(n, args.max_seq_len))
+        wdl = np.lib.format.open_memmap(f"{config.DATA_DIR}/{split}_wdl.npy", mode="w+",
+                                        dtype=np.float32, shape=(n, 3))
+        start = 0
+        print(f"Tokenizing {split}...")
+        for chunk in tqdm(pd.read_csv(csv_path, chunksize=args.chunksize), total=-(-n // args.chunksize)):
+            end = start + len(chunk)
+            tokens[start:end] = tokenizer.encode_batch(chunk["FEN"].tolist(), dtype=np.uint8)
+            wdl[start:end] = chunk[["Win_Probability", "Draw_Probability", "Lose_Probability"]].to_numpy(np.float32)
+            start = end
+        tokens.flush()
+        wdl.flush()
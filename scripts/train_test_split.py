@@ -1,25 +1,76 @@
-from sklearn.model_selection import train_test_split
+import hashlib
+import numpy as np
 import pandas as pd
 import config
+from argparse import ArgumentParser
+
+# fold boundaries in percent: 80% train, 10% val, 10% test
+FOLDS = [("train", 80), ("val", 90), ("test", 100)]
+
+def digest64(strings):
+    '''returns: uint64 array of 8 byte blake2b digests, stable across runs and machines unlike hash()'''
+    digests = b"".join(hashlib.blake2b(string.encode(), digest_size=8).digest() for string in strings)
+    return np.frombuffer(digests, dtype=np.uint64)
+
+def assign_folds(game_ids):
+    '''returns: fold index of every game id, decided by its digest alone so a game always lands in the same fold'''
+    unique_ids, inverse = np.unique(np.asarray(game_ids, dtype=str), return_inverse=True)
+    percent = digest64(unique_ids) % np.uint64(100)
+    return np.searchsorted([upper for _, upper in FOLDS], percent, side="right")[inverse]
+
+class DigestSet:
+    '''
+    Set of FEN digests kept as sorted, disjoint uint64 blocks. A new block is merged into the previous one
+    whenever it is at least as large, so there are only ever O(log n) blocks to search.
+    '''
+    def __init__(self):
+        self.blocks = list()
+
+    def __len__(self):
+        return sum(map(len, self.blocks))
+
+    def add(self, digests):
+        '''
+        Adds digests to the set.
+        returns: boolean mask of the digests seen for the first time, repeats within digests only count once
+        '''
+        _, first = np.unique(digests, return_index=True)
+        new = np.zeros(len(digests), dtype=bool)
+        new[first] = True
+        for block in self.blocks:
+            positions = np.searchsorted(block, digests).clip(max=len(block) - 1)
+            new &= block[positions] != digests
+        block = np.sort(digests[new])
+        while self.blocks and len(self.blocks[-1]) <= len(block):
+            block = np.sort(np.concatenate([self.blocks.pop(), block]))
+        if len(block):
+            self.blocks.append(block)
+        return new
 
 if __name__ == "__main__":
-    df = pd.read_csv(f"{config.DATA_DIR}/annotated_games.csv")
-    df.info(memory_usage='deep')
-
-    unique_game_ids = df['Game ID'].unique()
-    # split game ids into 80% train, 10% val, 10% test
-    train_ids, val_test_ids = train_test_split(unique_game_ids, test_size=0.2, random_state=42)
-    val_ids, test_ids = train_test_split(val_test_ids, test_size=0.5, random_state=42)
-
-    train_df = df[df['Game ID'].isin(train_ids)].copy()
-    val_df = df[df['Game ID'].isin(val_ids)].copy()
-    test_df = df[df['Game ID'].isin(test_ids)].copy()
-
-    # remove duplicate boards within folds but NOT across folds
-    train_df.drop_duplicates(subset=['FEN'], inplace=True)
-    val_df.drop_duplicates(subset=['FEN'], inplace=True)
-    test_df.drop_duplicates(subset=['FEN'], inplace=True)
-
-    train_df.to_csv(f'{config.DATA_DIR}/train.csv', index=False)
-    val_df.to_csv(f'{config.DATA_DIR}/val.csv', index=False)
-    test_df.to_csv(f'{config.DATA_DIR}/test.csv', index=False)
+    parser = ArgumentParser(description="Split annotated positions into train/val/test folds by game, deduplicating FENs within each fold")
+    parser.add_argument("--chunksize", type=int, default=500_000, help="Rows read and written at a time")
+    args = parser.parse_args()
+
+    seen = [DigestSet() for _ in FOLDS]
+    written = [0] * len(FOLDS)
+    total = 0
+    outputs = [open(f"{config.DATA_DIR}/{name}.csv", "w", encoding="utf-8", newline="") for name, _ in FOLDS]
+    try:
+        for index, chunk in enumerate(pd.read_csv(f"{config.DATA_DIR}/annotated_games.csv", chunksize=args.chunksize)):
+            total += len(chunk)
+            folds = assign_folds(chunk["Game ID"])
+            digests = digest64(chunk["FEN"])
+            for fold, output in enumerate(outputs):
+                in_fold = np.flatnonzero(folds == fold)
+                # remove duplicate boards within folds but NOT across folds
+                keep = in_fold[seen[fold].add(digests[in_fold])]
+                chunk.iloc[keep].to_csv(output, header=index == 0, index=False)
+                written[fold] += len(keep)
+    finally:
+        for output in outputs:
+            output.close()
+
+    for (name, _), count in zip(FOLDS, written):
+        print(f"{name}: {count} positions")
+    print(f"{total - sum(written)} duplicates dropped out of {total} positions")
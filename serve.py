@@ -0,0 +1,202 @@
+import asyncio
+import json
+import socket
+import sys
+import time
+from collections import OrderedDict, deque
+from argparse import ArgumentParser
+import numpy as np
+from inference import add_model_args, load_model, evaluate_tokens
+
+class BatchingEvaluator:
+    '''
+    Coalesces concurrent FEN evaluation requests into batched forward passes.
+    A batch is run as soon as it holds max_batch_size FENs or its oldest request has waited max_wait_ms.
+    Recent results are kept in an LRU cache so repeated positions skip the model entirely.
+    FENs are tokenized as they arrive, so a malformed FEN fails only its own request and never the batch it would have joined.
+    '''
+    def __init__(self, model, tokenizer, device, max_batch_size=256, max_wait_ms=2.0, cache_size=100_000):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.pending = asyncio.Queue()
+        # the batch whose forward pass is running, failed together with the queue if run() dies
+        self.in_flight = list()
+        self.task = None
+        # rolling windows for the stats report
+        self.latencies_ms = deque(maxlen=10_000)
+        self.batch_sizes = deque(maxlen=10_000)
+        self.requests = 0
+        self.cache_hits = 0
+
+    async def evaluate(self, fen):
+        tick = time.perf_counter()
+        self.requests += 1
+        if fen in self.cache:
+            self.cache.move_to_end(fen)
+            self.cache_hits += 1
+            wdl = self.cache[fen]
+        else:
+            # raises for a malformed FEN before anything is queued
+            tokens = self.tokenizer.encode_batch([fen])[0]
+            future = asyncio.get_running_loop().create_future()
+            self.pending.put_nowait((fen, tokens, future))
+            wdl = await future
+        self.latencies_ms.append((time.perf_counter() - tick) * 1000)
+        return wdl
+
+    def start(self):
+        '''Starts the batching loop, restarting it if it ever dies so requests are never left waiting on a dead task'''
+        self.task = asyncio.create_task(self.run())
+        self.task.add_done_callback(self._run_done)
+
+    def _run_done(self, task):
+        if task.cancelled():
+            return
+        error = task.exception()
+        print(f"Batching loop failed, restarting it: {error!r}", file=sys.stderr, flush=True)
+        failed = self.in_flight
+        self.in_flight = list()
+        while not self.pending.empty():
+            failed.append(self.pending.get_nowait())
+        for *_, future in failed:
+            if not future.done():
+                future.set_exception(RuntimeError(f"Batching loop failed: {error!r}"))
+        self.start()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.pending.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.pending.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            self.in_flight = batch
+            # the same position may have been requested several times while the batch filled up
+            unique = dict()
+            for fen, tokens, _ in batch:
+                unique.setdefault(fen, tokens)
+            fens = list(unique)
+            self.batch_sizes.append(len(fens))
+            try:
+                # the forward pass runs in a thread so the event loop keeps accepting requests meanwhile
+                wdls = await loop.run_in_executor(None, evaluate_tokens, self.model, np.stack(list(unique.values())), self.device)
+            except Exception as error:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                self.in_flight = list()
+                continue
+
+            results = dict(zip(fens, wdls.tolist()))
+            for fen, wdl in results.items():
+                self.cache[fen] = wdl
+                self.cache.move_to_end(fen)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            # a request whose client went away has already been cancelled
+            for fen, _, future in batch:
+                if not future.done():
+                    future.set_result(results[fen])
+            self.in_flight = list()
+
+    def stats(self):
+        latencies = np.array(self.latencies_ms) if self.latencies_ms else np.zeros(1)
+        batch_sizes = np.array(self.batch_sizes) if self.batch_sizes else np.zeros(1)
+        return {
+            "requests": self.requests,
+            "cache_hit_rate": self.cache_hits / self.requests if self.requests else 0.0,
+            "latency_ms": {f"p{q}": float(np.percentile(latencies, q)) for q in (50, 90, 99)},
+            "batch_size": {"mean": float(batch_sizes.mean()), "max": int(batch_sizes.max())},
+        }
+
+async def handle_connection(evaluator, reader, writer):
+    '''
+    Newline-delimited JSON protocol, one reply line per request line:
+    {"fen": fen} -> {"wdl": [w, d, l]}, {"fens": [...]} -> {"wdl": [[w, d, l], ...]}, {"cmd": "stats"} -> stats
+    '''
+    while line := await reader.readline():
+        try:
+            request = json.loads(line)
+            if request.get("cmd") == "stats":
+                reply = evaluator.stats()
+            elif "fens" in request:
+                reply = {"wdl": await asyncio.gather(*(evaluator.evaluate(fen) for fen in request["fens"]))}
+            else:
+                reply = {"wdl": await evaluator.evaluate(request["fen"])}
+        except Exception as error:
+            reply = {"error": repr(error)}
+        writer.write(json.dumps(reply).encode() + b"\n")
+        await writer.drain()
+    writer.close()
+
+async def report(evaluator, interval):
+    while True:
+        await asyncio.sleep(interval)
+        print(json.dumps(evaluator.stats()), flush=True)
+
+async def serve(args):
+    model, tokenizer = load_model(args)
+    evaluator = BatchingEvaluator(model, tokenizer, args.device, args.max_batch_size, args.max_wait_ms, args.cache_size)
+    handler = lambda reader, writer: handle_connection(evaluator, reader, writer)
+    if args.socket:
+        server = await asyncio.start_unix_server(handler, path=args.socket)
+    else:
+        server = await asyncio.start_server(handler, host="127.0.0.1", port=args.port)
+    print(f"Serving Rishi on {args.socket or f'127.0.0.1:{args.port}'}", flush=True)
+    evaluator.start()
+    if args.report_interval > 0:
+        reporter = asyncio.create_task(report(evaluator, args.report_interval))
+    async with server:
+        await server.serve_forever()
+
+class InferenceClient:
+    '''Blocking client for the server, one connection per client'''
+    def __init__(self, socket_path=None, port=8765):
+        if socket_path:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(socket_path)
+        else:
+            self.sock = socket.create_connection(("127.0.0.1", port))
+        self.file = self.sock.makefile("rwb")
+
+    def _request(self, request):
+        self.file.write(json.dumps(request).encode() + b"\n")
+        self.file.flush()
+        reply = json.loads(self.file.readline())
+        if "error" in reply:
+            raise RuntimeError(reply["error"])
+        return reply
+
+    def evaluate(self, fens):
+        '''returns: list of [win, draw, lose] probabilities for each FEN'''
+        return self._request({"fens": list(fens)})["wdl"]
+
+    def stats(self):
+        return self._request({"cmd": "stats"})
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Dynamic-batching inference server for Rishi")
+    add_model_args(parser)
+    parser.add_argument("--socket", help="Unix socket path to listen on instead of TCP")
+    parser.add_argument("--port", type=int, default=8765, help="TCP port on localhost to listen on")
+    parser.add_argument("--max_batch_size", type=int, default=256, help="Largest batch a forward pass will run")
+    parser.add_argument("--max_wait_ms", type=float, default=2.0, help="Longest a request waits for its batch to fill")
+    parser.add_argument("--cache_size", type=int, default=100_000, help="Number of FEN evaluations kept in the LRU cache")
+    parser.add_argument("--report_interval", type=float, default=60.0, help="Seconds between stats reports, 0 disables")
+    asyncio.run(serve(parser.parse_args()))
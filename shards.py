@@ -0,0 +1,119 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+COLUMNS = ["Game ID", "FEN", "CP", "Win_Probability", "Draw_Probability", "Lose_Probability"]
+# JSON object mapping every legal move to [cp, win, draw, lose] after it, written only by action value runs
+ACTION_VALUES_COLUMN = "Action_Values"
+MANIFEST_NAME = "manifest.jsonl"
+
+def read_manifest(directory):
+    '''
+    returns: list of (shard filename, game ids) for every shard that was completely written.
+    A line cut off by a crash is ignored, as is any shard file that never made it into the manifest.
+    '''
+    path = os.path.join(directory, MANIFEST_NAME)
+    entries = list()
+    if not os.path.exists(path):
+        return entries
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            entries.append((entry["shard"], entry["games"]))
+    return entries
+
+def completed_games(directory):
+    return {game_id for _, game_ids in read_manifest(directory) for game_id in game_ids}
+
+class ShardWriter:
+    '''
+    Buffers annotated games and writes them as columnar .npz shards of roughly shard_rows positions.
+    A game is recorded in the manifest only after the shard holding all of its rows is on disk,
+    so an interrupted run can be restarted and skip exactly the games that were finished.
+    '''
+    def __init__(self, directory, shard_rows=100_000, action_values=False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.shard_rows = shard_rows
+        self.columns = COLUMNS + [ACTION_VALUES_COLUMN] if action_values else COLUMNS
+        recorded = {shard for shard, _ in read_manifest(directory)}
+        # shards written just before a crash but never recorded would otherwise duplicate re-annotated games
+        for filename in os.listdir(directory):
+            if filename.endswith((".npz", ".npz.tmp")) and filename not in recorded:
+                os.remove(os.path.join(directory, filename))
+        self.next_shard = max((int(shard[len("shard_"):-len(".npz")]) + 1 for shard in recorded), default=0)
+        self.manifest = open(os.path.join(directory, MANIFEST_NAME), "a+", encoding="utf-8")
+        # terminate a line cut off by a crash so the next entry starts cleanly
+        if self.manifest.tell() > 0:
+            self.manifest.seek(self.manifest.tell() - 1)
+            if self.manifest.read(1) != "\n":
+                self.manifest.write("\n")
+        self._reset()
+
+    def _reset(self):
+        self.game_ids = list()
+        self.rows = {column: list() for column in self.columns}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_game(self, game_id, boards, evaluations, action_values=None):
+        if action_values is not None:
+            self.rows[ACTION_VALUES_COLUMN].extend(json.dumps(values, separators=(",", ":")) for values in action_values)
+        for fen, (cp, win, draw, loss) in zip(boards, evaluations):
+            self.rows["Game ID"].append(game_id)
+            self.rows["FEN"].append(fen)
+            self.rows["CP"].append(str(cp))
+            self.rows["Win_Probability"].append(np.nan if win is None else win)
+            self.rows["Draw_Probability"].append(np.nan if draw is None else draw)
+            self.rows["Lose_Probability"].append(np.nan if loss is None else loss)
+        self.game_ids.append(game_id)
+        if len(self.rows["FEN"]) >= self.shard_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.game_ids:
+            return
+        shard = f"shard_{self.next_shard:05d}.npz"
+        tmp_path = os.path.join(self.directory, f"{shard}.tmp")
+        # unicode columns are stored natively, so shards load back without pickle or text parsing
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **{column: np.array(values) for column, values in self.rows.items()})
+        os.replace(tmp_path, os.path.join(self.directory, shard))
+        self.manifest.write(json.dumps({"shard": shard, "games": self.game_ids}) + "\n")
+        self.manifest.flush()
+        os.fsync(self.manifest.fileno())
+        self.next_shard += 1
+        self._reset()
+
+    def close(self):
+        self.flush()
+        self.manifest.close()
+
+def merge_shards(directory, out_path):
+    '''
+    Appends the recorded shards one at a time to a single CSV, so memory stays at one shard however large the run.
+    returns: number of rows written
+    '''
+    entries = read_manifest(directory)
+    columns = list(COLUMNS)
+    if entries:
+        with np.load(os.path.join(directory, entries[0][0])) as data:
+            if ACTION_VALUES_COLUMN in data.files:
+                columns.append(ACTION_VALUES_COLUMN)
+    rows = 0
+    with open(out_path, "w", encoding="utf-8", newline="") as out:
+        pd.DataFrame(columns=columns).to_csv(out, index=False)
+        for shard, _ in entries:
+            with np.load(os.path.join(directory, shard)) as data:
+                df = pd.DataFrame({column: data[column] for column in columns})
+            df.to_csv(out, mode="a", header=False, index=False)
+            rows += len(df)
+    return rows
@@ -0,0 +1,140 @@
+import os
+import sys
+import json
+import time
+import random
+import itertools
+import numpy as np
+from argparse import ArgumentParser
+import config
+from oracle import PikafishEngine, EnginePool
+from xiangqi import Board
+
+# throughput benchmark for oracle.PikafishEngine and the EnginePool annotation pipeline.
+# Runs against tests/fake_uci_engine.py by default, so results only depend on oracle.py and the machine;
+# --engine pikafish benchmarks the real binary instead. Results can be saved as a JSON baseline and later runs
+# compared against it, exiting non-zero when positions/s drops by more than --tolerance anywhere in the grid.
+FAKE_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_uci_engine.py")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "oracle_baseline.json")
+
+def random_games(n, plies, seed=42):
+    rng = random.Random(seed)
+    games = list()
+    while len(games) < n:
+        board = Board()
+        moves = list()
+        for _ in range(plies):
+            legal = board.legal_moves()
+            if not legal:
+                break
+            moves.append(rng.choice(legal))
+            board.push(moves[-1])
+        games.append(moves)
+    return games
+
+def command_overhead(binary, movetime, repeats):
+    '''returns: engine start up time, isready round trip and search overhead beyond movetime, all in ms'''
+    tick = time.perf_counter()
+    engine = PikafishEngine(1, timeout=config.PIKAFISH_TIMEOUT_S, binary=binary)
+    startup = (time.perf_counter() - tick) * 1000
+
+    tick = time.perf_counter()
+    for _ in range(repeats):
+        engine.send("isready")
+        engine._wait_for("readyok")
+    round_trip = (time.perf_counter() - tick) * 1000 / repeats
+
+    timings = list()
+    for _ in range(repeats):
+        tick = time.perf_counter()
+        engine.evaluate([], movetime)
+        timings.append((time.perf_counter() - tick) * 1000 - movetime)
+    engine.quit()
+    return {"startup_ms": startup, "isready_ms": round_trip, "search_overhead_ms": float(np.median(timings))}
+
+def annotation_throughput(binary, games, workers, threads, movetime):
+    positions = sum(map(len, games))
+    with EnginePool(workers, threads, binary=binary) as pool:
+        # engines are started before the clock runs, start up is measured separately
+        pool.start()
+        tick = time.perf_counter()
+        for _ in pool.map(lambda engine, moves: engine.annotate_moves(moves, movetime), games, key=len):
+            pass
+        elapsed = time.perf_counter() - tick
+        failed = len(pool.failed)
+    # the best a pool can do is every engine searching back to back
+    ideal = workers * 1000 / movetime if movetime else float("inf")
+    return {"workers": workers, "threads": threads, "movetime_ms": movetime, "positions": positions,
+            "failed_games": failed, "elapsed_s": elapsed, "positions_per_sec": positions / elapsed,
+            "efficiency": positions / elapsed / ideal,
+            "overhead_ms_per_position": elapsed * workers * 1000 / positions - movetime}
+
+def compare(results, baseline, tolerance):
+    '''returns: descriptions of grid points whose positions/s fell more than tolerance below the baseline'''
+    key = lambda row: (row["workers"], row["threads"], row["movetime_ms"])
+    reference = {key(row): row for row in baseline["grid"]}
+    regressions = list()
+    for row in results["grid"]:
+        old = reference.get(key(row))
+        if old is None:
+            continue
+        change = row["positions_per_sec"] / old["positions_per_sec"] - 1
+        if change < -tolerance:
+            regressions.append(f"workers={row['workers']} threads={row['threads']} movetime={row['movetime_ms']}ms: "
+                               f"{old['positions_per_sec']:.1f} -> {row['positions_per_sec']:.1f} positions/s ({change:+.0%})")
+    return regressions
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Oracle throughput benchmark")
+    parser.add_argument("--engine", choices=["fake", "pikafish"], default="fake",
+                        help="Benchmark against the deterministic fake engine or the real Pikafish binary")
+    parser.add_argument("--info_lines", type=int, default=20, help="Info lines per search printed by the fake engine")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4], help="Pool sizes to benchmark")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1], help="Engine thread counts to benchmark")
+    parser.add_argument("--movetimes", type=int, nargs="+", default=[5, 20], help="Movetimes in ms to benchmark")
+    parser.add_argument("--games", type=int, default=16, help="Number of synthetic games annotated per grid point")
+    parser.add_argument("--plies", type=int, default=40, help="Plies per synthetic game")
+    parser.add_argument("--repeats", type=int, default=20, help="Commands timed for the overhead measurement")
+    parser.add_argument("--out", help="Write the results as JSON to this path")
+    parser.add_argument("--save_baseline", action="store_true", help="Write the results to --baseline")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline JSON to compare against or save to")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Largest allowed relative drop in positions/s")
+    args = parser.parse_args()
+
+    if args.engine == "fake":
+        binary = [sys.executable, FAKE_ENGINE, "--info_lines", str(args.info_lines)]
+    else:
+        binary = config.PATH_TO_PIKAFISH_BINARY
+    games = random_games(args.games, args.plies)
+
+    results = {"engine": args.engine, "info_lines": args.info_lines, "cpus": len(os.sched_getaffinity(0)),
+               "overhead": command_overhead(binary, min(args.movetimes), args.repeats), "grid": list()}
+    print(", ".join(f"{name} {value:.2f}" for name, value in results["overhead"].items()))
+    for workers, threads, movetime in itertools.product(args.workers, args.threads, args.movetimes):
+        row = annotation_throughput(binary, games, workers, threads, movetime)
+        results["grid"].append(row)
+        print(f"workers {workers:3d} threads {threads:3d} movetime {movetime:5d} ms: {row['positions_per_sec']:9.1f} positions/s, "
+              f"efficiency {row['efficiency']:.0%}, overhead {row['overhead_ms_per_position']:.2f} ms/position")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        # throughput only compares on the same engine and CPU count, and for the fake engine the same output volume
+        fields = ["engine", "cpus"] + (["info_lines"] if args.engine == "fake" else [])
+        mismatched = [f"{field} {baseline.get(field)} vs {results[field]}" for field in fields if baseline.get(field) != results[field]]
+        if mismatched:
+            print(f"WARNING: baseline was recorded with different settings ({', '.join(mismatched)}), not comparing")
+        else:
+            regressions = compare(results, baseline, args.tolerance)
+            for regression in regressions:
+                print("REGRESSION " + regression)
+            if regressions:
+                raise SystemExit(f"{len(regressions)} grid points regressed by more than {args.tolerance:.0%}")
+            print(f"No regressions against {args.baseline}")
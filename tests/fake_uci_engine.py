@@ -0,0 +1,85 @@
+import os
+import sys
+import time
+import zlib
+import random
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from xiangqi import Board, START_FEN
+
+# deterministic stand-in for Pikafish that speaks enough UCI for oracle.py, so benchmarks run without the real engine.
+# A search sleeps for its movetime (scaled by --latency) and prints --info_lines info lines per MultiPV line,
+# with scores seeded by the position so the same position always gets the same evaluation.
+def parse_args():
+    parser = ArgumentParser(description="Fake UCI engine")
+    parser.add_argument("--latency", type=float, default=1.0, help="Fraction of the requested movetime a search sleeps for")
+    parser.add_argument("--overhead_ms", type=float, default=0.0, help="Extra sleep per search in ms")
+    parser.add_argument("--info_lines", type=int, default=20, help="Info lines (depths) printed per MultiPV line and search")
+    parser.add_argument("--nps", type=int, default=1_000_000, help="Nodes per second per thread reported in info lines")
+    return parser.parse_args()
+
+def search(board, movetime, multipv, threads, args, out):
+    time.sleep(max(0.0, movetime * args.latency + args.overhead_ms) / 1000)
+    moves = board.legal_moves()
+    if not moves:
+        # the side to move is mated
+        out.write("info depth 0 score mate 0\nbestmove (none)\n")
+        return
+    rng = random.Random(zlib.crc32(board.fen().encode()))
+    scores = sorted((rng.randint(-400, 400) for _ in moves), reverse=True)
+    ranked = sorted(moves, key=lambda move: zlib.crc32((board.fen() + move).encode()))
+    nps = args.nps * threads
+    lines = list()
+    for depth in range(1, args.info_lines + 1):
+        nodes = nps * movetime // 1000 * depth // args.info_lines
+        for pv in range(min(multipv, len(moves))):
+            cp = scores[pv] + rng.randint(-10, 10) * (args.info_lines - depth) // args.info_lines
+            win = max(0, min(1000, 500 + cp))
+            lose = max(0, min(1000 - win, 500 - cp))
+            lines.append(f"info depth {depth} seldepth {depth + 3} multipv {pv + 1} score cp {cp} "
+                         f"wdl {win} {1000 - win - lose} {lose} nodes {nodes} nps {nps} hashfull 0 tbhits 0 "
+                         f"time {movetime * depth // args.info_lines} pv {ranked[pv]}")
+    lines.append(f"bestmove {ranked[0]}")
+    out.write("\n".join(lines) + "\n")
+
+def main():
+    args = parse_args()
+    out = sys.stdout
+    board = Board()
+    threads, multipv = 1, 1
+    for line in sys.stdin:
+        tokens = line.split()
+        if not tokens:
+            continue
+        command = tokens[0]
+        if command == "uci":
+            out.write("id name FakeUCI\nid author Rishi\noption name Threads type spin default 1 min 1 max 1024\nuciok\n")
+        elif command == "isready":
+            out.write("readyok\n")
+        elif command == "setoption" and len(tokens) >= 5:
+            name, value = tokens[2], tokens[4]
+            if name == "Threads":
+                threads = int(value)
+                out.write(f"info string Using {threads} thread{'s' if threads > 1 else ''}\n")
+            elif name == "MultiPV":
+                multipv = int(value)
+        elif command == "position":
+            if tokens[1] == "startpos":
+                fen, rest = START_FEN, tokens[2:]
+            else:
+                fen, rest = " ".join(tokens[2:8]), tokens[8:]
+            board = Board(fen)
+            if rest and rest[0] == "moves":
+                board.push_moves(rest[1:])
+        elif command == "d":
+            out.write(f"\nFen: {board.fen()}\nKey: {zlib.crc32(board.fen().encode()):016X}\nCheckers:\n")
+        elif command == "go":
+            movetime = int(tokens[tokens.index("movetime") + 1]) if "movetime" in tokens else 0
+            search(board, movetime, multipv, threads, args, out)
+        elif command == "quit":
+            break
+        out.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import random
+import time
+from argparse import ArgumentParser
+from tokenizer import BoardTokenizer
+from xiangqi import Board
+from position import positions_from_fens
+
+# microbenchmark comparing BoardTokenizer.encode one FEN at a time against encode_batch and Position arrays
+def random_fens(n, seed=42):
+    rng = random.Random(seed)
+    fens = list()
+    while len(fens) < n:
+        board = Board()
+        for _ in range(rng.randint(1, 120)):
+            moves = board.legal_moves()
+            if not moves:
+                break
+            board.push(rng.choice(moves))
+            fens.append(board.fen())
+    return fens[:n]
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Tokenizer throughput benchmark")
+    parser.add_argument("--csv", help="CSV with a FEN column to benchmark on, random game positions otherwise")
+    parser.add_argument("-n", type=int, default=100_000, help="Number of FENs")
+    parser.add_argument("--repeats", type=int, default=3, help="Best of this many timings is reported")
+    args = parser.parse_args()
+
+    fens = pd.read_csv(args.csv, nrows=args.n)["FEN"].tolist() if args.csv else random_fens(args.n)
+    tokenizer = BoardTokenizer(97)
+
+    def best_time(fn):
+        timings = list()
+        for _ in range(args.repeats):
+            tick = time.perf_counter()
+            result = fn()
+            timings.append(time.perf_counter() - tick)
+        return min(timings), result
+
+    encode_time, expected = best_time(lambda: np.stack([tokenizer.encode(fen) for fen in fens]))
+    batch_time, actual = best_time(lambda: tokenizer.encode_batch(fens))
+    decode_time, decoded = best_time(lambda: tokenizer.decode_batch(actual))
+    parse_time, positions = best_time(lambda: positions_from_fens(fens))
+    positions_time, from_positions = best_time(lambda: tokenizer.encode_positions(positions))
+    assert np.array_equal(expected, actual), "encode_batch disagrees with encode"
+    assert np.array_equal(expected, from_positions), "encode_positions disagrees with encode"
+    assert decoded == list(fens), "decode_batch does not invert encode_batch"
+
+    print(f"encode:       {len(fens) / encode_time:12,.0f} FENs/s")
+    print(f"encode_batch: {len(fens) / batch_time:12,.0f} FENs/s ({encode_time / batch_time:.1f}x)")
+    print(f"decode_batch: {len(fens) / decode_time:12,.0f} FENs/s")
+    print(f"positions_from_fens: {len(fens) / parse_time:12,.0f} FENs/s, {positions.nbytes / len(fens):.0f} bytes per position")
+    print(f"encode_positions:    {len(fens) / positions_time:12,.0f} positions/s ({encode_time / positions_time:.1f}x encode)")
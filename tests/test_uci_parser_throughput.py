@@ -0,0 +1,78 @@
+import re
+import random
+import time
+from argparse import ArgumentParser
+from oracle import SearchParser
+
+# microbenchmark comparing the streaming SearchParser against collecting every line and rescanning it with regexes
+def search_output(max_depth, multipv, seed=42):
+    '''Synthetic output of one Pikafish search, shaped like "go movetime" with UCI_ShowWDL on'''
+    rng = random.Random(seed)
+    lines = ["info string NNUE evaluation using pikafish.nnue"]
+    nodes = 0
+    for depth in range(1, max_depth + 1):
+        for pv in range(1, multipv + 1):
+            nodes += rng.randint(100, 5000)
+            cp = rng.randint(-300, 300)
+            win = rng.randint(0, 1000)
+            draw = rng.randint(0, 1000 - win)
+            moves = " ".join(rng.choice(["h2e2", "h9g7", "b0c2", "c6c5", "h0g2", "i9h9"]) for _ in range(depth))
+            lines.append(f"info depth {depth} seldepth {depth + 4} multipv {pv} score cp {cp} wdl {win} {draw} {1000 - win - draw} "
+                         f"nodes {nodes} nps {nodes * 20} hashfull 3 tbhits 0 time {depth * 3} pv {moves}")
+        lines.append(f"info depth {depth} currmove h2e2 currmovenumber 1")
+    lines.append("bestmove h2e2 ponder h9g7")
+    return lines
+
+def rescan(lines):
+    '''The previous approach: keep every line, then search each one for every field'''
+    kept = list()
+    for line in lines:
+        kept.append(line)
+        if "bestmove" in line:
+            break
+    centipawns, win_prob, draw_prob, lose_prob = None, None, None, None
+    for line in kept:
+        if "wdl" in line:
+            match = re.search(r"wdl (\d+) (\d+) (\d+)", line)
+            if match:
+                win_prob = int(match.group(1)) / 1000
+                draw_prob = int(match.group(2)) / 1000
+                lose_prob = int(match.group(3)) / 1000
+        if "score cp" in line:
+            match = re.search(r"score cp (-?\d+)", line)
+            if match:
+                centipawns = int(match.group(1))
+    return centipawns, win_prob, draw_prob, lose_prob
+
+def stream(lines):
+    parser = SearchParser()
+    for line in lines:
+        if parser.feed(line):
+            break
+    return parser.final().evaluation()
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="UCI output parser throughput benchmark")
+    parser.add_argument("--depth", type=int, default=20, help="Depth reached by each synthetic search")
+    parser.add_argument("--searches", type=int, default=2000, help="Number of synthetic searches")
+    parser.add_argument("--repeats", type=int, default=3, help="Best of this many timings is reported")
+    args = parser.parse_args()
+
+    # with MultiPV > 1 the rescan keeps the last line of any PV, so only single-PV output is compared for equality
+    outputs = [search_output(args.depth, 1, seed) for seed in range(args.searches)]
+    n_lines = sum(map(len, outputs))
+
+    def best_time(fn):
+        timings = list()
+        for _ in range(args.repeats):
+            tick = time.perf_counter()
+            result = [fn(lines) for lines in outputs]
+            timings.append(time.perf_counter() - tick)
+        return min(timings), result
+
+    rescan_time, expected = best_time(rescan)
+    stream_time, actual = best_time(stream)
+    assert expected == actual, "SearchParser disagrees with rescanning the lines"
+
+    print(f"rescan: {n_lines / rescan_time:12,.0f} lines/s")
+    print(f"stream: {n_lines / stream_time:12,.0f} lines/s ({rescan_time / stream_time:.1f}x)")
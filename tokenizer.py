@@ -1,5 +1,6 @@
 import re
 import numpy as np
+from position import CODE_TO_CHAR, CHAR_TO_CODE, INVALID, NUM_SQUARES, POSITION_DTYPE, to_array
 
 class BoardTokenizer:
     def __init__(self, expected_seq_len):
@@ -13,6 +14,30 @@ class BoardTokenizer:
                       '[MASK]']
         self.vocab_size = len(self.vocab)
         self.token_to_idx = dict(zip(self.vocab, range(len(self.vocab))))
+        # the first 90 tokens are the board rank by rank; a horizontal flip mirrors each rank and leaves the metadata alone
+        self.num_board_tokens = 90
+        mirrored_board = np.arange(self.num_board_tokens).reshape(10, 9)[:, ::-1].ravel()
+        self.flip_permutation = np.concatenate([mirrored_board, np.arange(self.num_board_tokens, expected_seq_len)])
+
+        # lookup tables for the batched paths: FEN board -> one character per square, ASCII code -> token index and back
+        self.board_table = str.maketrans({str(n): "." * n for n in range(1, 10)} | {"/": "", "b": "e", "B": "E"})
+        self.char_to_idx = np.full(256, -1, dtype=np.int64)
+        for token, idx in self.token_to_idx.items():
+            if len(token) == 1:
+                self.char_to_idx[ord(token)] = idx
+        self.idx_to_char = np.array([ord(token) if len(token) == 1 else 0 for token in self.vocab], dtype=np.uint8)
+        self.empty_run_regex = re.compile(r"\.+")
+
+        # lookup tables for Position arrays: piece code + 7 -> token index, token index -> piece code or clock digit
+        self.code_to_idx = self.char_to_idx[np.frombuffer(bytes(CODE_TO_CHAR).translate(bytes.maketrans(b"bB", b"eE")), dtype=np.uint8)]
+        self.digit_to_idx = self.char_to_idx[np.frombuffer(b"0123456789", dtype=np.uint8)]
+        self.idx_to_code = CHAR_TO_CODE[self.idx_to_char.copy()]
+        self.idx_to_code[self.token_to_idx["E"]] = CHAR_TO_CODE[ord("B")]
+        self.idx_to_code[self.token_to_idx["e"]] = CHAR_TO_CODE[ord("b")]
+        # "b" on the board means black to move, never an elephant
+        self.idx_to_code[self.token_to_idx["b"]] = INVALID
+        self.idx_to_digit = np.array([int(token) if token.isdigit() else -1 for token in self.vocab], dtype=np.int64)
+        self.clock_places = np.array([100, 10, 1])
 
     def encode(self, fen):
         board, metadata = fen.split(" ", 1)
@@ -31,4 +56,85 @@ class BoardTokenizer:
         tokenized = list(rows) + list(whose_move) + list(capture_clock) + list(halfmove_clock)
         tokenized = np.array([self.token_to_idx[token] for token in tokenized])
         assert tokenized.shape[0] == self.expected_seq_len, f"Expected tokenized FEN to be {self.expected_seq_len} chars, got {tokenized.shape[0]}"
-        return tokenized
\ No newline at end of file
+        return tokenized
+
+    def encode_batch(self, fens, dtype=np.int64):
+        '''
+        @param fens: list or array of FENs
+        @param dtype: integer dtype of the result, uint8 is enough to hold every token index
+        returns: (N, expected_seq_len) array of token indices, row i identical to encode(fens[i])
+
+        Each FEN is expanded with one str.translate call, then all rows are mapped to token indices
+        with a single table lookup over the concatenated bytes.
+        '''
+        rows = list()
+        for fen in fens:
+            board, whose_move, _, _, capture_clock, halfmove_clock = fen.split(" ")
+            rows.append(board.translate(self.board_table) + whose_move + capture_clock.zfill(3) + halfmove_clock.zfill(3))
+        for row, fen in zip(rows, fens):
+            if len(row) != self.expected_seq_len:
+                raise ValueError(f"Expected tokenized FEN to be {self.expected_seq_len} chars, got {len(row)} for {fen!r}")
+        chars = np.frombuffer("".join(rows).encode("ascii"), dtype=np.uint8).reshape(len(rows), self.expected_seq_len)
+        tokenized = self.char_to_idx[chars]
+        if (tokenized < 0).any():
+            raise ValueError("FEN contains characters outside of the vocabulary")
+        return tokenized.astype(dtype, copy=False)
+
+    def encode_positions(self, positions, dtype=np.int64):
+        '''
+        @param positions: list of Positions or a structured array with POSITION_DTYPE
+        returns: (N, expected_seq_len) array of token indices, identical to encode_batch of their FENs but without any string work
+        '''
+        array = positions if isinstance(positions, np.ndarray) else to_array(positions)
+        if self.expected_seq_len != NUM_SQUARES + 7:
+            raise ValueError(f"Positions tokenize to {NUM_SQUARES + 7} tokens, tokenizer expects {self.expected_seq_len}")
+        if len(array) and max(array["rule60"].max(), array["fullmove"].max()) > 999:
+            raise ValueError("Clocks above 999 do not fit in three digit tokens")
+        tokens = np.empty((len(array), self.expected_seq_len), dtype=dtype)
+        tokens[:, :NUM_SQUARES] = self.code_to_idx[array["board"].astype(np.intp) + 7]
+        tokens[:, NUM_SQUARES] = np.where(array["red_to_move"], self.token_to_idx["w"], self.token_to_idx["b"])
+        for offset, clock in ((NUM_SQUARES + 1, "rule60"), (NUM_SQUARES + 4, "fullmove")):
+            digits = array[clock][:, None].astype(np.int64) // self.clock_places % 10
+            tokens[:, offset:offset + 3] = self.digit_to_idx[digits]
+        return tokens
+
+    def decode_positions(self, tokens):
+        '''
+        @param tokens: (N, expected_seq_len) array of token indices
+        returns: structured array with POSITION_DTYPE, the inverse of encode_positions
+        '''
+        tokens = np.asarray(tokens)
+        board = self.idx_to_code[tokens[:, :NUM_SQUARES]]
+        if (board == INVALID).any():
+            raise ValueError("Board tokens contain tokens that are not squares")
+        array = np.empty(len(tokens), dtype=POSITION_DTYPE)
+        array["board"] = board
+        array["red_to_move"] = tokens[:, NUM_SQUARES] == self.token_to_idx["w"]
+        array["rule60"] = self.idx_to_digit[tokens[:, NUM_SQUARES + 1:NUM_SQUARES + 4]] @ self.clock_places
+        array["fullmove"] = self.idx_to_digit[tokens[:, NUM_SQUARES + 4:NUM_SQUARES + 7]] @ self.clock_places
+        return array
+
+    def decode(self, tokens):
+        return self.decode_batch(np.asarray(tokens)[None, :])[0]
+
+    def decode_batch(self, tokens):
+        '''
+        @param tokens: (N, expected_seq_len) array of token indices
+        returns: list of N FENs, the inverse of encode_batch
+        '''
+        tokens = np.asarray(tokens)
+        chars = self.idx_to_char[tokens]
+        if (chars == 0).any():
+            raise ValueError("Cannot decode [MASK] tokens")
+        text = chars.tobytes().decode("ascii")
+        fens = list()
+        n_board = self.num_board_tokens
+        for start in range(0, len(text), self.expected_seq_len):
+            row = text[start:start + self.expected_seq_len]
+            board = "/".join(row[i:i + 9] for i in range(0, n_board, 9))
+            board = self.empty_run_regex.sub(lambda m: str(len(m.group(0))), board).replace("e", "b").replace("E", "B")
+            whose_move = row[n_board]
+            capture_clock = int(row[n_board + 1:n_board + 4])
+            halfmove_clock = int(row[n_board + 4:n_board + 7])
+            fens.append(f"{board} {whose_move} - - {capture_clock} {halfmove_clock}")
+        return fens
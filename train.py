@@ -1,12 +1,16 @@
 import torch
-from dataset import AnnotatedBoardsDataset
+from dataset import AnnotatedBoardsDataset, PretokenizedBoardsDataset, BoardFlip
 import config
 from tokenizer import BoardTokenizer
 from model import TransformerClassifier
+from metrics import StepTimer, MetricsLogger, peak_memory_mb
+from checkpoint import AsyncCheckpointer, capture_rng_state, restore_rng_state, latest_checkpoint, load_checkpoint, to_cpu
 import numpy as np
 import time
 import random
 import argparse
+import os
+import contextlib
 
 def get_args():
     parser = argparse.ArgumentParser(description="Training configuration options")
@@ -14,13 +18,15 @@ def get_args():
     parser.add_argument("--max_epochs", type=int, default=100,
                         help="Maximum number of epochs to train for")
     parser.add_argument("--batch_size", type=int, default=2048,
-                        help="Batch size per iteration")
+                        help="Batch size per iteration, per process when launched with torchrun")
     parser.add_argument("--patience", type=int, default=3,
                         help="Early stopping patience")
     parser.add_argument("--learning_rate", type=float, default=1e-4,
                         help="Initial learning rate for Adam optimizer")
     parser.add_argument("--board_flip_p", type=float, default=0.5,
                         help="Probability of horizontally flipping the board for data augmentation")
+    parser.add_argument("--flip_in_loader", action="store_true",
+                        help="If specified, apply board flips in the DataLoader collate on CPU instead of on the training device")
     parser.add_argument("--d_model", type=int, default=256,
                         help="Transformer embedding dimension")
     parser.add_argument("--n_heads", type=int, default=4,
@@ -33,8 +39,34 @@ def get_args():
                         help="Label smoothing factor in [0.0, 1.0]")
     parser.add_argument("--dropout", type=float, default=0.1,
                         help="Dropout rate")
+    parser.add_argument("--pretokenized", action="store_true",
+                        help="If specified, read the memory mapped .npy files written by scripts/pretokenize.py instead of the CSVs")
+    parser.add_argument("--num_workers", type=int, default=0,
+                        help="Number of DataLoader worker processes")
+    parser.add_argument("--fast", action="store_true",
+                        help="If specified, use scaled_dot_product_attention encoder layers and compute the loss from log-probabilities directly")
+    parser.add_argument("--compile", action="store_true",
+                        help="If specified, compile the model with torch.compile")
+    parser.add_argument("--activation_checkpointing", action="store_true",
+                        help="If specified, recompute encoder activations during backward to fit larger batches or models")
+    parser.add_argument("--metrics_log", default=f"{config.LOGS_DIR}/train_metrics.jsonl",
+                        help="JSONL file that per-step and per-epoch metrics are appended to")
+    parser.add_argument("--log_every", type=int, default=50,
+                        help="Log the timing breakdown of every n-th training step, 0 logs epoch summaries only")
+    parser.add_argument("--profile", action="store_true",
+                        help="If specified, record a torch.profiler trace over a window of training steps in the first epoch")
+    parser.add_argument("--profile_steps", type=int, nargs=3, default=[5, 2, 5], metavar=("WAIT", "WARMUP", "ACTIVE"),
+                        help="Profiler schedule: steps skipped, warmup steps and recorded steps")
+    parser.add_argument("--checkpoint_dir", default=config.CHECKPOINTS_DIR,
+                        help="Directory that periodic training checkpoints are written to")
+    parser.add_argument("--checkpoint_every", type=int, default=1,
+                        help="Write a checkpoint every n epochs, 0 disables checkpoints")
+    parser.add_argument("--keep_checkpoints", type=int, default=3,
+                        help="Number of most recent epoch checkpoints to keep besides the best one, 0 keeps only best.pt (and leaves nothing to --resume)")
+    parser.add_argument("--resume", action="store_true",
+                        help="If specified, continue from the latest checkpoint in --checkpoint_dir")
     parser.add_argument("--save_model", action="store_true",
-                        help="If specified, save the trained model at the end of training")
+                        help="If specified, save the weights with the best validation loss at the end of training")
 
     return parser.parse_args()
 
@@ -52,8 +84,30 @@ if __name__ == "__main__":
     LABEL_SMOOTHING = args.label_smoothing
     DROPOUT = args.dropout
     SAVE_MODEL = args.save_model
+    PRETOKENIZED = args.pretokenized
+    NUM_WORKERS = args.num_workers
+    FLIP_IN_LOADER = args.flip_in_loader
+    FAST = args.fast
+    COMPILE = args.compile
+    ACTIVATION_CHECKPOINTING = args.activation_checkpointing
+    LOG_EVERY = args.log_every
+    PROFILE = args.profile
 
     device = "cuda" if torch.cuda.is_available() else "cpu"
+    # torchrun sets these, a plain `python train.py` is a world of one
+    DISTRIBUTED = "WORLD_SIZE" in os.environ
+    RANK = int(os.environ.get("RANK", 0))
+    LOCAL_RANK = int(os.environ.get("LOCAL_RANK", 0))
+    WORLD_SIZE = int(os.environ.get("WORLD_SIZE", 1))
+    IS_MAIN = RANK == 0
+    if DISTRIBUTED:
+        if device == "cuda":
+            torch.cuda.set_device(LOCAL_RANK)
+        torch.distributed.init_process_group(backend="nccl" if device == "cuda" else "gloo")
+        # processes on one node would otherwise each spawn a thread per core and fight over them
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", WORLD_SIZE))
+        torch.set_num_threads(max(1, len(os.sched_getaffinity(0)) // local_world_size))
+
     torch.manual_seed(42)
     if device == "cuda": 
         torch.cuda.manual_seed(42)
@@ -64,50 +118,169 @@ if __name__ == "__main__":
 
     tokenizer = BoardTokenizer(MAX_SEQ_LEN)
 
-    train_ds = AnnotatedBoardsDataset(f'{config.DATA_DIR}/train.csv', tokenizer, BOARD_FLIP_P)
-    val_ds = AnnotatedBoardsDataset(f'{config.DATA_DIR}/val.csv', tokenizer)
-    test_ds = AnnotatedBoardsDataset(f'{config.DATA_DIR}/test.csv', tokenizer)
+    # flips are a token permutation applied to whole training batches, either in the loader or on the device
+    board_flip = BoardFlip(tokenizer, BOARD_FLIP_P)
+
+    if PRETOKENIZED:
+        train_ds = PretokenizedBoardsDataset(f'{config.DATA_DIR}/train')
+        val_ds = PretokenizedBoardsDataset(f'{config.DATA_DIR}/val')
+        test_ds = PretokenizedBoardsDataset(f'{config.DATA_DIR}/test')
+
+        # the dataset slices whole batches itself, so the loader hands it index batches instead of single indices
+        def batch_loader(ds, shuffle, collate_fn=None):
+            if DISTRIBUTED:
+                sampler = torch.utils.data.DistributedSampler(ds, shuffle=shuffle, seed=42)
+            else:
+                sampler = torch.utils.data.RandomSampler(ds) if shuffle else torch.utils.data.SequentialSampler(ds)
+            batch_sampler = torch.utils.data.BatchSampler(sampler, BATCH_SIZE, drop_last=False)
+            return torch.utils.data.DataLoader(ds, batch_size=None, sampler=batch_sampler, num_workers=NUM_WORKERS,
+                                               collate_fn=collate_fn)
 
-    train_loader = torch.utils.data.DataLoader(train_ds, batch_size=BATCH_SIZE, shuffle=True)
-    val_loader = torch.utils.data.DataLoader(val_ds, batch_size=BATCH_SIZE, shuffle=False)
-    test_loader = torch.utils.data.DataLoader(val_ds, batch_size=BATCH_SIZE, shuffle=False)
+        train_loader = batch_loader(train_ds, shuffle=True, collate_fn=board_flip.collate_batch if FLIP_IN_LOADER else None)
+        val_loader = batch_loader(val_ds, shuffle=False)
+        test_loader = batch_loader(val_ds, shuffle=False)
+    else:
+        train_ds = AnnotatedBoardsDataset(f'{config.DATA_DIR}/train.csv', tokenizer)
+        val_ds = AnnotatedBoardsDataset(f'{config.DATA_DIR}/val.csv', tokenizer)
+        test_ds = AnnotatedBoardsDataset(f'{config.DATA_DIR}/test.csv', tokenizer)
+
+        train_sampler = torch.utils.data.DistributedSampler(train_ds, shuffle=True, seed=42) if DISTRIBUTED else None
+        val_sampler = torch.utils.data.DistributedSampler(val_ds, shuffle=False) if DISTRIBUTED else None
+        train_loader = torch.utils.data.DataLoader(train_ds, batch_size=BATCH_SIZE, shuffle=train_sampler is None,
+                                                   sampler=train_sampler, num_workers=NUM_WORKERS,
+                                                   collate_fn=board_flip.collate if FLIP_IN_LOADER else None)
+        val_loader = torch.utils.data.DataLoader(val_ds, batch_size=BATCH_SIZE, shuffle=False, sampler=val_sampler,
+                                                 num_workers=NUM_WORKERS)
+        test_loader = torch.utils.data.DataLoader(val_ds, batch_size=BATCH_SIZE, shuffle=False, num_workers=NUM_WORKERS)
 
     VOCAB_SIZE = tokenizer.vocab_size
-    model = TransformerClassifier(VOCAB_SIZE, MAX_SEQ_LEN, D_MODEL, 3, N_LAYERS, N_HEADS, DROPOUT).to(device)
+    model = TransformerClassifier(VOCAB_SIZE, MAX_SEQ_LEN, D_MODEL, 3, N_LAYERS, N_HEADS, DROPOUT,
+                                  fast_attention=FAST, activation_checkpointing=ACTIVATION_CHECKPOINTING).to(device)
+    # every rank starts from identical weights, but should draw different board flips and dropout masks
+    torch.manual_seed(42 + RANK)
+    # the DDP wrapper and compiled module share parameters with model, which is what gets saved
+    forward = model
+    if DISTRIBUTED:
+        forward = torch.nn.parallel.DistributedDataParallel(model, device_ids=[LOCAL_RANK] if device == "cuda" else None)
+    if COMPILE:
+        forward = torch.compile(forward)
+
+    def predict_log_probs(inputs):
+        if FAST:
+            return forward(inputs, output="log_probs")
+        # KL Divergence expects probabilities in the log-space
+        return torch.log(forward(inputs) + 1e-8)
+
     optimizer = torch.optim.Adam(model.parameters(), lr=LEARNING_RATE)
     criterion = torch.nn.KLDivLoss(reduction="batchmean")
 
     parameter_count = sum(p.numel() for p in model.parameters())
-    print(f"Model has {parameter_count/1e6:.1f} M params")
+    if IS_MAIN: print(f"Model has {parameter_count/1e6:.1f} M params" + (f", training on {WORLD_SIZE} processes" if DISTRIBUTED else ""))
+
+    def all_reduce_sum(*values):
+        '''sums python numbers over all ranks'''
+        if not DISTRIBUTED:
+            return values
+        summed = torch.tensor(values, dtype=torch.float64, device=device)
+        torch.distributed.all_reduce(summed)
+        return summed.tolist()
+
+    metrics_log = MetricsLogger(args.metrics_log if IS_MAIN else None)
+    metrics_log.log("config", device=device, parameters=parameter_count, world_size=WORLD_SIZE, **vars(args))
+    timer = StepTimer(device)
+    if PROFILE and IS_MAIN:
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if device == "cuda":
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        wait, warmup, active = args.profile_steps
+        trace_dir = f"{config.LOGS_DIR}/profile/{metrics_log.run_id}"
+        profiler = torch.profiler.profile(activities=activities,
+                                          schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+                                          on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+                                          record_shapes=True, profile_memory=True)
+        print(f"Writing profiler trace to {trace_dir}")
+    else:
+        profiler = contextlib.nullcontext()
+    step = 0
     old_val_loss = np.inf
+    best_val_loss = np.inf
+    best_state = None
     patience = PATIENCE
+    start_epoch = 0
     scaler = torch.amp.GradScaler(device)
-    for epoch in range(MAX_EPOCHS):
+
+    if args.resume:
+        checkpoint_path = latest_checkpoint(args.checkpoint_dir)
+        if checkpoint_path is None:
+            raise FileNotFoundError(f"No checkpoint to resume from in {args.checkpoint_dir}")
+        checkpoint = load_checkpoint(checkpoint_path)
+        model.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        scaler.load_state_dict(checkpoint["scaler"])
+        start_epoch = checkpoint["epoch"] + 1
+        step = checkpoint["step"]
+        patience = checkpoint["patience"]
+        old_val_loss = checkpoint["old_val_loss"]
+        best_val_loss = checkpoint["best_val_loss"]
+        best_state = checkpoint["best_model"]
+        # ranks draw from different generators, each restores its own
+        rng_states = checkpoint["rng"]
+        if len(rng_states) == WORLD_SIZE:
+            restore_rng_state(rng_states[RANK])
+        elif IS_MAIN:
+            print(f"Checkpoint was written by {len(rng_states)} processes, not restoring RNG states")
+        if IS_MAIN: print(f"Resuming from {checkpoint_path} at epoch {start_epoch}")
+        del checkpoint
+
+    checkpointer = AsyncCheckpointer(args.checkpoint_dir, args.keep_checkpoints) if args.checkpoint_every > 0 and IS_MAIN else None
+    for epoch in range(start_epoch, MAX_EPOCHS):
         model.train()
         train_loss = 0.0
         total = 0
+        timer.reset()
+        if device == "cuda": torch.cuda.reset_peak_memory_stats()
+        if DISTRIBUTED:
+            # reshuffles the shards every epoch, the same way on every rank
+            sampler = train_loader.sampler.sampler if PRETOKENIZED else train_loader.sampler
+            sampler.set_epoch(epoch)
 
         # train
         tick = time.time()
-        for inputs, labels in train_loader:
-            inputs, labels = inputs.to(device), labels.to(device)
+        # the profiler only records the first epoch, its schedule stops recording after the active window
+        with profiler if epoch == start_epoch else contextlib.nullcontext():
+            for inputs, labels in timer.iterate(train_loader):
+                with timer.phase("transfer"):
+                    inputs, labels = inputs.to(device), labels.to(device)
+                    if not FLIP_IN_LOADER:
+                        inputs = board_flip(inputs)
+                    inputs = inputs.long()
 
-            optimizer.zero_grad()
-            with torch.autocast(device_type=device):
-                outputs = model(inputs)
-                # KL Divergence expects probabilities in the log-space
-                log_outputs = torch.log(outputs + 1e-8)
-                # smooth targets to reduce overconfidence in totally winning or dead lost positions
-                smoothed_labels = (1 - LABEL_SMOOTHING) * labels + LABEL_SMOOTHING / labels.size(-1)
-                loss = criterion(log_outputs, smoothed_labels)
-            scaler.scale(loss).backward()
-            scaler.step(optimizer)
-            scaler.update()
-
-            train_loss += loss.item() * inputs.size(0)
-            total += inputs.size(0)
-        
+                with timer.phase("forward_backward"):
+                    optimizer.zero_grad()
+                    with torch.autocast(device_type=device):
+                        log_outputs = predict_log_probs(inputs)
+                        # smooth targets to reduce overconfidence in totally winning or dead lost positions
+                        smoothed_labels = (1 - LABEL_SMOOTHING) * labels + LABEL_SMOOTHING / labels.size(-1)
+                        loss = criterion(log_outputs, smoothed_labels)
+                    scaler.scale(loss).backward()
+                with timer.phase("optimizer"):
+                    scaler.step(optimizer)
+                    scaler.update()
+
+                train_loss += loss.item() * inputs.size(0)
+                total += inputs.size(0)
+                timer.end_step(inputs.size(0))
+                step += 1
+                if PROFILE and IS_MAIN and epoch == start_epoch:
+                    profiler.step()
+                if LOG_EVERY and step % LOG_EVERY == 0:
+                    metrics_log.log("step", epoch=epoch, step=step, loss=loss.item(), **timer.step_record())
+
+        train_loss, total = all_reduce_sum(train_loss, total)
         avg_train_loss = train_loss / total
+        train_summary = timer.summary()
+        # each rank timed its own share of the data
+        train_summary["samples_per_sec"], = all_reduce_sum(train_summary["samples_per_sec"])
         
         # validate
         val_loss = 0.0
@@ -116,27 +289,53 @@ if __name__ == "__main__":
         with torch.no_grad():
             with torch.autocast(device_type=device):
                 for inputs, labels in val_loader:
-                    inputs, labels = inputs.to(device), labels.to(device)
-                    outputs = model(inputs)
-                    # KL Divergence expects probabilities in the log-space
-                    log_outputs = torch.log(outputs + 1e-8)
+                    inputs, labels = inputs.to(device).long(), labels.to(device)
+                    log_outputs = predict_log_probs(inputs)
                     loss = criterion(log_outputs, labels)
 
                     val_loss += loss.item() * inputs.size(0)
                     total += inputs.size(0)
 
+        # every rank sees a different shard of the validation set, so early stopping must use the global loss
+        val_loss, total = all_reduce_sum(val_loss, total)
         avg_val_loss = val_loss / total
         if device == "cuda": torch.cuda.synchronize()
         tock = time.time()
         elapsed_mins = (tock - tick) // 60
+        peak_memory = peak_memory_mb(device)
+        metrics_log.log("epoch", epoch=epoch, step=step, train_loss=avg_train_loss, val_loss=avg_val_loss,
+                        elapsed_s=tock - tick, peak_memory_mb=peak_memory, **train_summary)
 
-        print(f"Losses for epoch {epoch}: \t Train: {avg_train_loss:.3f} \t Val: {avg_val_loss:.3f} \t in {elapsed_mins} mins")
+        if IS_MAIN:
+            print(f"Losses for epoch {epoch}: \t Train: {avg_train_loss:.3f} \t Val: {avg_val_loss:.3f} \t in {elapsed_mins} mins")
+            print(f"\t {train_summary['samples_per_sec']:.0f} samples/s, peak memory {peak_memory:.0f} MB, step time split: " +
+                  ", ".join(f"{phase} {train_summary[f'{phase}_frac']:.0%}" for phase in StepTimer.PHASES))
         if avg_val_loss < old_val_loss:
             patience = PATIENCE
         else:
             patience -= 1
+        old_val_loss = avg_val_loss
+        is_best = avg_val_loss < best_val_loss
+        if is_best:
+            best_val_loss = avg_val_loss
+            best_state = to_cpu(model.state_dict())
+
+        if args.checkpoint_every > 0 and ((epoch + 1) % args.checkpoint_every == 0 or patience <= 0):
+            # gathered on every rank, since all of them have to take part in the collective
+            rng_states = [None] * WORLD_SIZE
+            if DISTRIBUTED:
+                torch.distributed.all_gather_object(rng_states, capture_rng_state())
+            else:
+                rng_states[0] = capture_rng_state()
+            if checkpointer is not None:
+                checkpointer.save({"model": model.state_dict(), "optimizer": optimizer.state_dict(), "scaler": scaler.state_dict(),
+                                   "rng": rng_states, "epoch": epoch, "step": step, "patience": patience,
+                                   "old_val_loss": old_val_loss, "best_val_loss": best_val_loss, "best_model": best_state},
+                                  epoch, is_best)
         if patience <= 0:
             break
-        old_val_loss = avg_val_loss
 
-    if SAVE_MODEL: torch.save(model.state_dict(), f"{config.MODELS_DIR}/rishi.pt")
\ No newline at end of file
+    metrics_log.close()
+    if checkpointer is not None: checkpointer.close()
+    if SAVE_MODEL and IS_MAIN: torch.save(best_state if best_state is not None else model.state_dict(), f"{config.MODELS_DIR}/rishi.pt")
+    if DISTRIBUTED: torch.distributed.destroy_process_group()
\ No newline at end of file
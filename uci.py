@@ -1,7 +1,11 @@
 import re
+import sys
+import time
+from argparse import ArgumentParser
 from oracle import *
 import threading
-from config import PIKAFISH_THREADS, PATH_TO_NNUE
+from config import PIKAFISH_THREADS, PATH_TO_NNUE, MODELS_DIR
+from xiangqi import Board, START_FEN
 
 option_info = {
   "Threads": {"type": "spin", "default": 1, "min": 1, "max": 1024},
@@ -41,33 +45,159 @@ def live_print_engine_output(engine):
   
   threading.Thread(target=printer, daemon=True).start()
 
-engine = PikafishEngine(PIKAFISH_THREADS)
+def run_pikafish_proxy():
+  engine = PikafishEngine(PIKAFISH_THREADS)
 
-engine.send(f"setoption name EvalFile value {PATH_TO_NNUE}")
-engine.send("isready")
-engine._wait_for("readyok")
+  engine.send(f"setoption name EvalFile value {PATH_TO_NNUE}")
+  engine.send("isready")
+  engine._wait_for("readyok")
 
-# Start live output thread
-live_print_engine_output(engine)
+  # Start live output thread
+  live_print_engine_output(engine)
 
-quit_flag = False
-while not quit_flag:
-  try:
-    cmd = input().strip()
+  quit_flag = False
+  while not quit_flag:
+    try:
+      cmd = input().strip()
+      if not cmd:
+          continue
+
+      # Handle quit
+      if cmd.lower() == "quit":
+          quit_flag = True
+          engine.quit()
+          break
+
+      # Send UCI command to engine
+      engine.send(cmd)
+
+    except KeyboardInterrupt:
+      quit_flag = True
+      engine.quit()
+      break
+
+class RishiEngine:
+  '''
+  Searchless engine: every legal move is scored by evaluating all child positions in one batched forward pass.
+  torch and the model are only loaded on the first isready/go so that uci is answered immediately.
+  '''
+  def __init__(self, model_args):
+    self.model_args = model_args
+    self.model = None
+    self.board = Board()
+
+  def load(self):
+    if self.model is not None:
+      return
+    import torch
+    from inference import load_model
+    torch.set_num_threads(options["Threads"])
+    self.model, self.tokenizer = load_model(self.model_args)
+    # the first forward pass pays for lazy initialisation inside torch, do it before the clock is running
+    self.best_move()
+
+  def set_position(self, cmd):
+    if cmd[1] == "startpos":
+      fen, rest = START_FEN, cmd[2:]
+    else:
+      fen, rest = " ".join(cmd[2:8]), cmd[8:]
+    self.board = Board(fen)
+    if rest and rest[0] == "moves":
+      self.board.push_moves(rest[1:])
+
+  def best_move(self):
+    '''
+    returns: tuple of (best move, its win/draw/lose probabilities for the side to move, number of moves scored),
+    best move being None if the side to move has no legal moves
+    '''
+    from inference import evaluate_fens
+    moves = self.board.legal_moves()
+    if not moves:
+      return None, None, 0
+    children = [self.board.copy().push_moves([move]).fen() for move in moves]
+    wdl = evaluate_fens(self.model, self.tokenizer, children, self.model_args.device)
+    # child evaluations are from the opponent's perspective, so pick the move that leaves them most likely to lose
+    best = int(wdl[:, 2].argmax())
+    lose, draw, win = wdl[best]
+    return moves[best], (win, draw, lose), len(moves)
+
+  def go(self):
+    self.load()
+    tick = time.perf_counter()
+    move, wdl, nodes = self.best_move()
+    elapsed_ms = (time.perf_counter() - tick) * 1000
+    if move is None:
+      print("info depth 0 score mate 0")
+      print("bestmove (none)")
+      return elapsed_ms
+    win, draw, lose = (round(p * 1000) for p in wdl)
+    print(f"info depth 1 nodes {nodes} time {round(elapsed_ms)} wdl {win} {draw} {lose} pv {move}")
+    print(f"info string time to bestmove {elapsed_ms:.2f} ms")
+    print(f"bestmove {move}")
+    return elapsed_ms
+
+def run_rishi(model_args):
+  sys.stdout.reconfigure(line_buffering=True)
+  engine = RishiEngine(model_args)
+  while True:
+    try:
+      cmd = input().split()
+    except (EOFError, KeyboardInterrupt):
+      break
     if not cmd:
-        continue
-
-    # Handle quit
-    if cmd.lower() == "quit":
-        quit_flag = True
-        engine.quit()
-        break
-
-    # Send UCI command to engine
-    engine.send(cmd)
-
-  except KeyboardInterrupt:
-    quit_flag = True
-    engine.quit()
-    break
-  
\ No newline at end of file
+      continue
+
+    if cmd[0] == "uci":
+      uci_handler()
+    elif cmd[0] == "isready":
+      engine.load()
+      print("readyok")
+    elif cmd[0] == "setoption":
+      setoption_handler(cmd)
+    elif cmd[0] == "ucinewgame":
+      engine.board = Board()
+    elif cmd[0] == "position":
+      engine.set_position(cmd)
+    elif cmd[0] == "go":
+      engine.go()
+    elif cmd[0] == "quit":
+      break
+
+def bench_rishi(model_args, plies):
+  '''Plays the model against itself and reports time to bestmove for every position'''
+  import numpy as np
+  engine = RishiEngine(model_args)
+  engine.load()
+  timings = list()
+  for _ in range(plies):
+    tick = time.perf_counter()
+    move, _, _ = engine.best_move()
+    timings.append((time.perf_counter() - tick) * 1000)
+    if move is None:
+      break
+    engine.board.push(move)
+  timings = np.array(timings)
+  print(f"{len(timings)} positions, time to bestmove ms: mean {timings.mean():.2f} "
+        f"p50 {np.percentile(timings, 50):.2f} p99 {np.percentile(timings, 99):.2f}")
+
+if __name__ == "__main__":
+  parser = ArgumentParser(description="UCI front end for Rishi")
+  parser.add_argument("--engine", choices=["pikafish", "rishi"], default="pikafish",
+                      help="Proxy commands to Pikafish or play with the searchless Rishi model")
+  parser.add_argument("--bench", type=int, metavar="PLIES",
+                      help="Instead of speaking UCI, time Rishi's bestmove over a self-play game of this many plies")
+  # model arguments are registered without importing torch, which is only needed once the model loads
+  parser.add_argument("--model_path", default=f"{MODELS_DIR}/rishi.pt")
+  parser.add_argument("--d_model", type=int, default=256)
+  parser.add_argument("--n_heads", type=int, default=4)
+  parser.add_argument("--n_layers", type=int, default=4)
+  parser.add_argument("--max_seq_len", type=int, default=97)
+  parser.add_argument("--device", default="cpu")
+  args = parser.parse_args()
+
+  if args.bench:
+    bench_rishi(args, args.bench)
+  elif args.engine == "rishi":
+    run_rishi(args)
+  else:
+    run_pikafish_proxy()
@@ -0,0 +1,266 @@
+import numpy as np
+from position import Position, CHAR_TO_CODE, CODE_TO_CHAR
+
+FILES = "abcdefghi"
+NUM_FILES = 9
+NUM_RANKS = 10
+START_FEN = "rnbakabnr/9/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RNBAKABNR w - - 0 1"
+
+ORTHOGONAL = ((1, 0), (-1, 0), (0, 1), (0, -1))
+DIAGONAL = ((1, 1), (1, -1), (-1, 1), (-1, -1))
+# (file delta, rank delta) of a horse move and the leg square that blocks it
+HORSE_MOVES = tuple(
+    ((df, dr), (df // 2, 0) if abs(df) == 2 else (0, dr // 2))
+    for df, dr in ((1, 2), (-1, 2), (1, -2), (-1, -2), (2, 1), (2, -1), (-2, 1), (-2, -1))
+)
+# Position boards are in FEN order, FEN_ORDER[i] is the square shown at index i
+FEN_ORDER = np.array([(NUM_RANKS - 1 - i // NUM_FILES) * NUM_FILES + i % NUM_FILES for i in range(NUM_FILES * NUM_RANKS)])
+
+def square(file, rank):
+    return rank * NUM_FILES + file
+
+def parse_square(name):
+    return square(FILES.index(name[0]), int(name[1]))
+
+def square_name(sq):
+    return FILES[sq % NUM_FILES] + str(sq // NUM_FILES)
+
+def parse_move(move):
+    '''Converts a long algebraic move such as h2e2 into (from square, to square)'''
+    return parse_square(move[:2]), parse_square(move[2:4])
+
+def move_name(from_sq, to_sq):
+    return square_name(from_sq) + square_name(to_sq)
+
+def mirror_fen(fen):
+    '''Flips the board left to right. Xiangqi is symmetric about the middle file so evaluations are unchanged.'''
+    board, metadata = fen.split(" ", 1)
+    return "/".join(row[::-1] for row in board.split("/")) + " " + metadata
+
+def _in_palace(file, rank, red):
+    return 3 <= file <= 5 and (0 <= rank <= 2 if red else 7 <= rank <= 9)
+
+def _on_own_side(rank, red):
+    return rank <= 4 if red else rank >= 5
+
+class Board:
+    '''
+    Xiangqi position with local move application and legal move generation.
+    Squares are indexed rank * 9 + file, with rank 0 being red's back rank as in long algebraic notation.
+    Pieces use FEN letters: uppercase for red, lowercase for black, None for an empty square.
+    '''
+    def __init__(self, fen=START_FEN):
+        board, turn, _, _, rule60, fullmove = fen.split()
+        self.squares = [None] * (NUM_FILES * NUM_RANKS)
+        for i, row in enumerate(board.split("/")):
+            rank = NUM_RANKS - 1 - i
+            file = 0
+            for char in row:
+                if char.isdigit():
+                    file += int(char)
+                else:
+                    self.squares[square(file, rank)] = char
+                    file += 1
+            if file != NUM_FILES:
+                raise ValueError(f"Invalid FEN rank {row!r} in {fen!r}")
+        self.red_to_move = turn == "w"
+        self.rule60 = int(rule60)
+        self.fullmove = int(fullmove)
+
+    @classmethod
+    def from_position(cls, position):
+        board = cls.__new__(cls)
+        board.squares = [None] * (NUM_FILES * NUM_RANKS)
+        for sq, char in zip(FEN_ORDER.tolist(), CODE_TO_CHAR[position.board.astype(np.intp) + 7].tobytes().decode("ascii")):
+            if char != ".":
+                board.squares[sq] = char
+        board.red_to_move = position.red_to_move
+        board.rule60 = position.rule60
+        board.fullmove = position.fullmove
+        return board
+
+    def position(self):
+        chars = "".join(self.squares[sq] or "." for sq in FEN_ORDER.tolist())
+        codes = CHAR_TO_CODE[np.frombuffer(chars.encode("ascii"), dtype=np.uint8)]
+        return Position(codes, self.red_to_move, self.rule60, self.fullmove)
+
+    def copy(self):
+        board = Board.__new__(Board)
+        board.squares = self.squares.copy()
+        board.red_to_move = self.red_to_move
+        board.rule60 = self.rule60
+        board.fullmove = self.fullmove
+        return board
+
+    def fen(self):
+        rows = list()
+        for rank in reversed(range(NUM_RANKS)):
+            row = ""
+            empty = 0
+            for file in range(NUM_FILES):
+                piece = self.squares[square(file, rank)]
+                if piece is None:
+                    empty += 1
+                    continue
+                if empty:
+                    row += str(empty)
+                    empty = 0
+                row += piece
+            if empty:
+                row += str(empty)
+            rows.append(row)
+        turn = "w" if self.red_to_move else "b"
+        return f"{'/'.join(rows)} {turn} - - {self.rule60} {self.fullmove}"
+
+    def push(self, move):
+        '''Plays a long algebraic move and returns the captured piece (None if the move is quiet)'''
+        from_sq, to_sq = parse_move(move)
+        piece = self.squares[from_sq]
+        if piece is None or piece.isupper() != self.red_to_move:
+            raise ValueError(f"No piece of the side to move on {move[:2]} in {self.fen()!r}")
+        captured = self.squares[to_sq]
+        self.squares[to_sq] = piece
+        self.squares[from_sq] = None
+        self.rule60 = 0 if captured else self.rule60 + 1
+        if not self.red_to_move:
+            self.fullmove += 1
+        self.red_to_move = not self.red_to_move
+        return captured
+
+    def push_moves(self, moves):
+        for move in moves:
+            self.push(move)
+        return self
+
+    def _friendly(self, piece, red):
+        return piece is not None and piece.isupper() == red
+
+    def _pseudo_legal_moves(self, red):
+        squares = self.squares
+        for from_sq, piece in enumerate(squares):
+            if piece is None or piece.isupper() != red:
+                continue
+            file, rank = from_sq % NUM_FILES, from_sq // NUM_FILES
+            kind = piece.upper()
+            targets = list()
+            if kind == "R" or kind == "C":
+                for df, dr in ORTHOGONAL:
+                    f, r = file + df, rank + dr
+                    screened = False
+                    while 0 <= f < NUM_FILES and 0 <= r < NUM_RANKS:
+                        target = squares[square(f, r)]
+                        if not screened:
+                            if target is None:
+                                targets.append((f, r))
+                            else:
+                                if kind == "R":
+                                    targets.append((f, r))
+                                    break
+                                screened = True
+                        elif target is not None:
+                            targets.append((f, r))
+                            break
+                        f, r = f + df, r + dr
+            elif kind == "N":
+                for (df, dr), (lf, lr) in HORSE_MOVES:
+                    f, r = file + df, rank + dr
+                    if 0 <= f < NUM_FILES and 0 <= r < NUM_RANKS and squares[square(file + lf, rank + lr)] is None:
+                        targets.append((f, r))
+            elif kind == "B":
+                for df, dr in DIAGONAL:
+                    f, r = file + 2 * df, rank + 2 * dr
+                    if 0 <= f < NUM_FILES and 0 <= r < NUM_RANKS and _on_own_side(r, red) \
+                            and squares[square(file + df, rank + dr)] is None:
+                        targets.append((f, r))
+            elif kind == "A":
+                for df, dr in DIAGONAL:
+                    if _in_palace(file + df, rank + dr, red):
+                        targets.append((file + df, rank + dr))
+            elif kind == "K":
+                for df, dr in ORTHOGONAL:
+                    if _in_palace(file + df, rank + dr, red):
+                        targets.append((file + df, rank + dr))
+            elif kind == "P":
+                forward = 1 if red else -1
+                if 0 <= rank + forward < NUM_RANKS:
+                    targets.append((file, rank + forward))
+                if not _on_own_side(rank, red):
+                    for df in (1, -1):
+                        if 0 <= file + df < NUM_FILES:
+                            targets.append((file + df, rank))
+            for f, r in targets:
+                to_sq = square(f, r)
+                if not self._friendly(squares[to_sq], red):
+                    yield from_sq, to_sq
+
+    def _king_attacked(self, red):
+        '''Is the king of the given side attacked, including by the opposing king across an open file?'''
+        squares = self.squares
+        king = "K" if red else "k"
+        try:
+            king_sq = squares.index(king)
+        except ValueError:
+            return True
+        file, rank = king_sq % NUM_FILES, king_sq // NUM_FILES
+        rook, cannon, horse, pawn, enemy_king = "rcnpk" if red else "RCNPK"
+
+        for df, dr in ORTHOGONAL:
+            f, r = file + df, rank + dr
+            screened = False
+            while 0 <= f < NUM_FILES and 0 <= r < NUM_RANKS:
+                piece = squares[square(f, r)]
+                if piece is not None:
+                    if not screened:
+                        if piece == rook or (piece == enemy_king and df == 0):
+                            return True
+                        screened = True
+                    else:
+                        if piece == cannon:
+                            return True
+                        break
+                f, r = f + df, r + dr
+
+        for (df, dr), (lf, lr) in HORSE_MOVES:
+            # a horse on king - delta reaches the king unless its own leg is blocked
+            f, r = file - df, rank - dr
+            if 0 <= f < NUM_FILES and 0 <= r < NUM_RANKS and squares[square(f, r)] == horse \
+                    and squares[square(f + lf, r + lr)] is None:
+                return True
+
+        # enemy pawns move towards us, so they attack from the rank in front of the king or from the side
+        forward = 1 if red else -1
+        if 0 <= rank + forward < NUM_RANKS and squares[square(file, rank + forward)] == pawn:
+            return True
+        for df in (1, -1):
+            if 0 <= file + df < NUM_FILES and squares[square(file + df, rank)] == pawn:
+                return True
+        return False
+
+    def legal_moves(self):
+        '''Returns all legal moves for the side to move in long algebraic notation'''
+        red = self.red_to_move
+        squares = self.squares
+        moves = list()
+        for from_sq, to_sq in self._pseudo_legal_moves(red):
+            piece, captured = squares[from_sq], squares[to_sq]
+            squares[to_sq], squares[from_sq] = piece, None
+            if not self._king_attacked(red):
+                moves.append(move_name(from_sq, to_sq))
+            squares[from_sq], squares[to_sq] = piece, captured
+        return moves
+
+    def is_check(self):
+        return self._king_attacked(self.red_to_move)
+
+    def is_checkmate(self):
+        '''In Xiangqi a side with no legal moves has lost, whether or not it is in check'''
+        red = self.red_to_move
+        squares = self.squares
+        for from_sq, to_sq in self._pseudo_legal_moves(red):
+            piece, captured = squares[from_sq], squares[to_sq]
+            squares[to_sq], squares[from_sq] = piece, None
+            attacked = self._king_attacked(red)
+            squares[from_sq], squares[to_sq] = piece, captured
+            if not attacked:
+                return False
+        return True